@@ -1,4 +1,5 @@
-from pipeline import load_pipeline, load_recordings, get_epochs
+from data_utils import load_pipeline
+from pipeline import load_recordings, get_epochs
 from sklearn.metrics import confusion_matrix
 import numpy as np
 
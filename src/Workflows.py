@@ -1,18 +1,14 @@
-from pathlib import Path
-
 import mne.preprocessing
-from sklearn.model_selection import RepeatedStratifiedKFold
-from skopt import BayesSearchCV
 from skopt.space import Categorical, Integer, Real
 
 from src.figures import create_plots_for_subject
 from recording import run_session
-from pipeline import evaluate_pipeline, get_epochs, bayesian_opt
-from data_utils import load_recordings, load_hyperparams, save_hyperparams, load_rec_params
+from pipeline import evaluate_pipeline, bayesian_opt, get_recordings_epochs
+from data_utils import load_hyperparams, save_hyperparams, load_rec_params, get_recent_rec_folders, load_recording_params
 import spectral
 import csp
 import sklearn
-import pandas as pd
+from search import find_best_models, SEARCH_N_ITER, RETUNE_N_ITER
 
 models = [
     {"model": sklearn.discriminant_analysis.LinearDiscriminantAnalysis, "search_space": {
@@ -74,42 +70,34 @@ def create_pipeline_for_subject(subject, pipeline=spectral, choose=False):
     return pipe
 
 
-def find_best_hyperparams_for_subject(subject=None, pipeline=spectral, choose=False):
+def find_best_hyperparams_for_subject(subject=None, pipeline=spectral, choose=False, use_filter_bank=False,
+                                      early_stopping=False):
     epochs, labels = load_epochs_for_subject(subject, choose)
-    best_hyperparams = bayesian_opt(epochs, labels, pipeline)
-    save_hyperparams(best_hyperparams, pipeline.name, subject)
+    best_hyperparams = bayesian_opt(epochs, labels, pipeline, use_filter_bank, early_stopping, subject=subject)
+    save_hyperparams(best_hyperparams, subject, pipeline.name)
 
 
-def find_best_pipeline_for_subject(subject=None, pipeline=csp):
-    Path(f'../{subject}_pipeline_results').mkdir(exist_ok=True)
+def find_best_pipeline_for_subject(subject=None, pipeline=csp, use_filter_bank=False, n_iter=SEARCH_N_ITER,
+                                   n_jobs=-1, early_stopping=False):
+    """
+    Search the hyperparams of the pipeline with every model, see search.find_best_models. The searches run
+    concurrently and their trials are stored in the trial database: calling this again after an interruption resumes
+    them, and after a new session warm starts them from the previous sessions' trials.
+    use_filter_bank: filter the epochs once on a fixed grid of bands (see pipeline.filter_bank_search), only supported
+    by pipelines that define filter_bank_l_freqs and filter_bank_h_freqs
+    early_stopping: prune poor candidates after their first folds, only the promising ones get the full CV
+    """
     epochs, labels = load_epochs_for_subject(subject)
-    results = []
-    for model in models:
-        pipe = pipeline.create_pipeline(model=model["model"])
-        opt = BayesSearchCV(
-            pipe,
-            {
-                **pipeline.bayesian_search_space,
-                **model["search_space"],
-            }
-            ,
-            verbose=0,
-            n_iter=100,
-            cv=RepeatedStratifiedKFold(n_repeats=1, n_splits=10),
-            n_jobs=-1,
-        )
-        opt.fit(epochs, labels)
-        print("Best parameter (CV score=%0.3f):" % opt.best_score_)
-        print(opt.best_params_)
-        result = {
-            **opt.best_params_,
-            "pipeline": pipeline.name,
-            "model": model["model"].__name__,
-            "accuracy": opt.best_score_,
-            "std": opt.cv_results_["std_test_score"][opt.best_index_],
-        }
-        results.append(result)
-    pd.DataFrame(results).to_csv(f'../{subject}_pipeline_results/{pipeline.name}_results.csv')
+    return find_best_models(subject, pipeline, models, epochs, labels, use_filter_bank, n_iter, n_jobs,
+                            early_stopping=early_stopping)
+
+
+def retune_pipeline_for_subject(subject=None, pipeline=csp, use_filter_bank=False, n_iter=RETUNE_N_ITER):
+    """
+    Short search after a new session of a subject whose pipeline was searched before: the searches are warm started
+    from the previous sessions' trials, their best candidates are evaluated first, and poor candidates are pruned early
+    """
+    return find_best_pipeline_for_subject(subject, pipeline, use_filter_bank, n_iter, early_stopping=True)
 
 
 def record_with_live_retraining(subject, pipeline=spectral, choose=False):
@@ -120,10 +108,10 @@ def record_with_live_retraining(subject, pipeline=spectral, choose=False):
 
 
 def load_epochs_for_subject(subject, choose=False):
-    raws, rec_params = load_recordings(subject, choose)
-    epochs, labels = get_epochs(raws, rec_params["trial_duration"], rec_params["calibration_duration"],
-                                reject_bad=not rec_params['use_synthetic_board'])
-    return epochs.get_data(), labels
+    rec_folders = get_recent_rec_folders(subject, choose)
+    # When multiple recordings are loaded, the recording params are taken from the first recording
+    rec_params = load_recording_params(rec_folders[0])
+    return get_recordings_epochs(rec_folders, rec_params["trial_duration"], rec_params["calibration_duration"])
 
 
 if __name__ == "__main__":
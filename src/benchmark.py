@@ -0,0 +1,196 @@
+"""
+Throughput benchmarks of the spectral and csp pipelines: every stage (preprocessing, feature extraction, fit, predict,
+online prediction of one epoch at a time with inference.InferenceRuntime and a full evaluate_pipeline) is timed
+separately on synthetic epochs of configurable size and optionally on recorded data.
+Results are written as json to BENCHMARKS_DIR so runs of different versions can be diffed.
+"""
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import mne
+import numpy as np
+import sklearn
+
+import csp
+import preprocessing
+import spectral
+from Marker import Marker
+from constants import BENCHMARKS_DIR
+from data_utils import get_recent_rec_folders, load_recording_params, now_datestring
+from inference import create_runtime
+from pipeline import evaluate_pipeline, get_recordings_epochs
+from preprocessing import FILTER_CACHE_DISK_BYTES, FilterCache
+
+# (n_epochs, n_channels, n_samples), samples at 125 Hz
+SYNTHETIC_SIZES = [(90, 13, 626), (360, 13, 626)]
+REPEATS = 5
+PIPELINES = [spectral, csp]
+RECORDED_SUBJECTS = []  # subjects whose most recent recordings are benchmarked too
+
+
+def synthetic_epochs(n_epochs, n_channels, n_samples, rng):
+    """
+    Random epochs (in V, like recorded epochs) with labels of all the markers
+    """
+    epochs = rng.normal(scale=10e-6, size=(n_epochs, n_channels, n_samples))
+    labels = np.resize(Marker.all(), n_epochs)
+    return epochs, labels
+
+
+def recorded_epochs(subject):
+    rec_folders = get_recent_rec_folders(subject)
+    rec_params = load_recording_params(rec_folders[0])
+    return get_recordings_epochs(rec_folders, rec_params["trial_duration"], rec_params["calibration_duration"])
+
+
+def time_stage(func, make_input, repeats):
+    """
+    Seconds taken by func(*make_input()) in every repeat, make_input isn't timed
+    """
+    durations = []
+    for _ in range(repeats):
+        args = make_input()
+        start = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def benchmark_pipeline(pipeline_module, make_data, repeats=REPEATS, evaluate=True):
+    """
+    make_data: function returning (epochs, labels).
+    The filter cache is cleared before every repeat (except in the preprocessing_cached stage). evaluate_pipeline runs
+    in this process, since its workers would use (and keep between runs) their own caches.
+    Returns {stage: [seconds of every repeat]}
+    """
+    pipeline = pipeline_module.create_pipeline()
+    preprocessor, feature_step = pipeline.steps[0][1], pipeline.steps[1][1]
+
+    def cold_data():
+        preprocessing.filter_cache.clear()
+        return make_data()
+
+    def epochs_input():
+        return cold_data()[:1]
+
+    def features_input():
+        epochs, labels = cold_data()
+        filtered = preprocessor.transform(epochs)
+        feature_step.fit(filtered, labels)
+        return filtered,
+
+    def predict_input():
+        epochs, labels = cold_data()
+        pipeline.fit(epochs, labels)
+        preprocessing.filter_cache.clear()
+        return epochs,
+
+    def runtime_input():
+        epochs, labels = make_data()
+        pipeline.fit(epochs, labels)
+        runtime = create_runtime(pipeline)
+        runtime.predict(epochs[0])
+        return runtime, epochs
+
+    def predict_online(runtime, epochs):
+        for epoch in epochs:
+            runtime.predict(epoch)
+
+    epochs, labels = make_data()
+    preprocessor.transform(epochs)
+    results = {
+        "preprocessing": time_stage(preprocessor.transform, epochs_input, repeats),
+        "preprocessing_cached": time_stage(preprocessor.transform, lambda: (epochs,), repeats),
+        "features": time_stage(feature_step.transform, features_input, repeats),
+        "fit": time_stage(pipeline.fit, cold_data, repeats),
+        "predict": time_stage(pipeline.predict, predict_input, repeats),
+        "online_predict": time_stage(predict_online, runtime_input, repeats),
+    }
+    if evaluate:
+        results["evaluate_pipeline"] = time_stage(lambda e, l: evaluate_pipeline(pipeline, e, l, n_jobs=1), cold_data, 1)
+    return results
+
+
+def run_benchmarks(datasets, pipelines=PIPELINES, repeats=REPEATS, evaluate=True):
+    """
+    datasets: {name: function returning (epochs, labels)}
+    """
+    records = []
+    # a private filter cache, so the benchmark neither hits nor fills the cache used for real work
+    cache_dir = tempfile.mkdtemp()
+    default_cache = preprocessing.filter_cache
+    preprocessing.filter_cache = FilterCache(cache_dir=cache_dir, max_disk_bytes=FILTER_CACHE_DISK_BYTES)
+    try:
+        for dataset_name, make_data in datasets.items():
+            n_epochs, n_channels, n_samples = make_data()[0].shape
+            for pipeline_module in pipelines:
+                results = benchmark_pipeline(pipeline_module, make_data, repeats, evaluate)
+                for stage, durations in results.items():
+                    records.append({
+                        "dataset": dataset_name,
+                        "n_epochs": n_epochs,
+                        "n_channels": n_channels,
+                        "n_samples": n_samples,
+                        "pipeline": pipeline_module.name,
+                        "stage": stage,
+                        "repeats": len(durations),
+                        "min_s": min(durations),
+                        "median_s": float(np.median(durations)),
+                        "epochs_per_s": n_epochs / float(np.median(durations)),
+                    })
+    finally:
+        preprocessing.filter_cache = default_cache
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return records
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__, "mne": mne.__version__,
+            "sklearn": sklearn.__version__, "machine": platform.machine(), "cpu_count": os.cpu_count()}
+
+
+def save_benchmarks(records, path=None):
+    if path is None:
+        Path(BENCHMARKS_DIR).mkdir(exist_ok=True)
+        path = os.path.join(BENCHMARKS_DIR, f'{now_datestring()}_benchmark.json')
+    with open(path, "w") as file:
+        json.dump({"environment": environment(), "results": records}, file, indent=2, sort_keys=True)
+    print(f'Benchmark results saved to {path}')
+    return path
+
+
+def print_benchmarks(records):
+    for record in records:
+        print(f'{record["dataset"]:>24} {record["pipeline"]:>9} {record["stage"]:>21}: '
+              f'{record["median_s"] * 1000:9.1f} ms ({record["epochs_per_s"]:9.0f} epochs/s)')
+
+
+def synthetic_datasets(sizes=SYNTHETIC_SIZES, seed=0):
+    rng = np.random.default_rng(seed)
+    return {f'synthetic_{n_epochs}x{n_channels}x{n_samples}': (
+        lambda size=(n_epochs, n_channels, n_samples): synthetic_epochs(*size, rng))
+        for n_epochs, n_channels, n_samples in sizes}
+
+
+def recorded_datasets(subjects):
+    datasets = {}
+    for subject in subjects:
+        epochs, labels = recorded_epochs(subject)
+        datasets[f'recorded_{subject}'] = lambda epochs=epochs, labels=labels: (epochs, labels)
+    return datasets
+
+
+if __name__ == "__main__":
+    benchmark_records = run_benchmarks({**synthetic_datasets(), **recorded_datasets(RECORDED_SUBJECTS)})
+    print_benchmarks(benchmark_records)
+    save_benchmarks(benchmark_records)
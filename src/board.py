@@ -3,6 +3,11 @@ from brainflow import BrainFlowInputParams
 from serial.tools import list_ports
 from brainflow import BoardIds, BoardShim
 import mne
+import numpy as np
+import os
+import threading
+import time
+from constants import RECORDINGS_DIR
 
 # This Message instructs the cyton dongle to configure electrodes gain as X6, and turn off last 3 electrodes
 # HARDWARE_SETTINGS_MSG = "x1030110Xx2030110Xx3030110Xx4030110Xx5030110Xx6030110Xx7030110Xx8030110XxQ030110XxW030110XxE030110XxR030110XxT030110XxY131000XxU131000XxI131000X "
@@ -12,10 +17,53 @@ NUM_CHANNELS_REMOVE = 3
 # EEG_CHAN_NAMES = ["C3", "C4", "Cz", "FC1", "FC2", "FC5", "FC6", "CP1", "CP2", "CP5", "CP6", "O1", "O2"]
 EEG_CHAN_NAMES = ["O1", "O2"]
 STIM_CHAN_NAME = "Stim Markers"
+RING_BUFFER_SECONDS = 60
+
+
+class RingBuffer:
+    """
+    Fixed size buffer holding the latest samples of a multichannel stream.
+    Every sample is written twice (at i and at i + capacity), so the latest n samples are always a contiguous slice
+    and can be returned as a view without copying.
+    """
+
+    def __init__(self, n_channels, capacity):
+        self.capacity = capacity
+        self.n_samples = 0  # total number of samples ever appended
+        self._data = np.zeros((n_channels, 2 * capacity))
+        self._pos = 0
+
+    def append(self, samples):
+        n_new = samples.shape[1]
+        self.n_samples += n_new
+        if n_new > self.capacity:
+            samples = samples[:, -self.capacity:]
+            n_new = self.capacity
+        idx = (self._pos + np.arange(n_new)) % self.capacity
+        self._data[:, idx] = samples
+        self._data[:, idx + self.capacity] = samples
+        self._pos = (self._pos + n_new) % self.capacity
+
+    def latest(self, n_samples):
+        """
+        View of the latest n_samples (or less if not enough were appended yet), valid until the next append
+        """
+        n_samples = min(n_samples, self.n_samples, self.capacity)
+        end = self._pos + self.capacity
+        return self._data[:, end - n_samples:end]
+
+    def get(self, start, stop):
+        """
+        View of samples [start, stop), indexed from the first sample ever appended.
+        Returns None if part of the range was not appended yet or was already overwritten.
+        """
+        if stop > self.n_samples or start < self.n_samples - self.capacity or start > stop:
+            return None
+        return self.latest(self.n_samples - start)[:, :stop - start]
 
 
 class Board:
-    def __init__(self, use_synthetic=False):
+    def __init__(self, use_synthetic=False, buffer_seconds=RING_BUFFER_SECONDS):
         params = BrainFlowInputParams()
         if use_synthetic:
             self.board_id = BoardIds.SYNTHETIC_BOARD
@@ -25,6 +73,14 @@ class Board:
         board = BoardShim(self.board_id, params)
         board.enable_dev_board_logger()
         self.brainflow_board = board
+        self._init_buffers(buffer_seconds)
+
+    def _init_buffers(self, buffer_seconds):
+        self.ring_buffer = RingBuffer(len(self.eeg_channels) + 1, int(self.sfreq * buffer_seconds))
+        self._info = None
+        self.markers = []  # (sample index, marker) of every marker recorded, sample indices are as in the ring buffer
+        # held while updating or reading the ring buffer, so it can be monitored from another thread during a session
+        self.lock = threading.RLock()
 
     def __enter__(self):
         self.brainflow_board.prepare_session()
@@ -55,13 +111,70 @@ class Board:
             return EEG_CHAN_NAMES
         return self.brainflow_board.get_eeg_names(self.board_id)[:-NUM_CHANNELS_REMOVE]
 
+    @property
+    def info(self):
+        """
+        mne info (with montage) of the data returned by the board, created once and reused
+        """
+        if self._info is None:
+            ch_types = (['eeg'] * len(self.eeg_channels)) + ['stim']
+            ch_names = self.channel_names + [STIM_CHAN_NAME]
+            self._info = mne.create_info(ch_names=ch_names, sfreq=self.sfreq, ch_types=ch_types)
+            self._info.set_montage("standard_1020")
+        return self._info
+
     def insert_marker(self, marker):
         self.brainflow_board.insert_marker(marker)
 
+    def update(self):
+        """
+        Move the samples recorded since the last update from BrainFlow's buffer to the ring buffer, which is the only
+        copy of the data afterwards. BrainFlow's buffer is always emptied: it's bounded, and a count followed by a read
+        of the latest samples would race with its streaming thread.
+        """
+        with self.lock:
+            data = self.brainflow_board.get_board_data()
+            n_new = data.shape[1]
+            if n_new > 0:
+                data = self._select_channels(data)
+                marker_idx = np.flatnonzero(data[-1])
+                self.markers.extend(zip(self.ring_buffer.n_samples + marker_idx, data[-1, marker_idx].astype(int)))
+                self.ring_buffer.append(data)
+            return n_new
+
+    def get_latest_data(self, seconds):
+        """
+        Update the ring buffer and return a view of the latest seconds of eeg + marker channels (in V).
+        The view is overwritten by later updates, copy it if it needs to be kept.
+        """
+        self.update()
+        return self.ring_buffer.latest(int(seconds * self.sfreq))
+
+    def get_latest_epoch(self, tmin, tmax):
+        """
+        Eeg data around the latest marker, the same samples mne.Epochs(raw, events, tmin=tmin, tmax=tmax) would pick.
+        Only the ring buffer is sliced, so the cost doesn't depend on the length of the session.
+        Returns (epoch, marker), or (None, None) if there is no marker yet or the epoch wasn't fully recorded yet.
+        """
+        with self.lock:
+            self.update()
+            if not self.markers:
+                return None, None
+            marker_idx, marker = self.markers[-1]
+            epoch = self.ring_buffer.get(marker_idx + round(tmin * self.sfreq),
+                                         marker_idx + round(tmax * self.sfreq) + 1)
+            if epoch is None:
+                return None, None
+            return epoch[:-1].copy(), marker
+
+    def get_latest_raw(self, seconds):
+        return mne.io.RawArray(self.get_latest_data(seconds), self.info, verbose=False)
+
     def get_data(self, clear_buffer=False, n_samples=None):
         """
         Get data that has been recorded to the board. (and clear the buffer by default)
         if n_samples is not passed all of the data is returned.
+        Only the samples since the last update are in BrainFlow's buffer, see update.
         """
         if not n_samples:
             n_samples = self.brainflow_board.get_board_data_count()
@@ -71,20 +184,133 @@ class Board:
         else:
             data = self.brainflow_board.get_current_board_data(n_samples)
 
+        return mne.io.RawArray(self._select_channels(data), self.info)
+
+    def _select_channels(self, data):
         # the only relevant channels are eeg channels + marker channel
         data[self.eeg_channels] = data[self.eeg_channels] / 1e6  # BrainFlow returns uV, convert to V for MNE
-        data = data[self.eeg_channels + [self.marker_channel]]
+        return data[self.eeg_channels + [self.marker_channel]]
+
 
-        # create mne info object
-        ch_types = (['eeg'] * len(self.eeg_channels)) + ['stim']
-        ch_names = self.channel_names + [STIM_CHAN_NAME]
-        info = mne.create_info(ch_names=ch_names, sfreq=self.sfreq, ch_types=ch_types)
+class ReplayBoard(Board):
+    """
+    Board streaming a saved raw.fif (with its stim channel) instead of a device, for running the online code paths
+    without hardware.
+    speed: 1 streams in real time, N N times faster. None streams as fast as possible: every poll of the board releases
+    the next REPLAY_CHUNK_SECONDS of data, so runs are deterministic regardless of machine speed.
+    use_recorded_markers: keep the markers of the recording (inserted markers are ignored), or stream the recording
+    without its markers and use the inserted ones instead.
+    """
+
+    def __init__(self, raw_path, speed=1, use_recorded_markers=True, buffer_seconds=RING_BUFFER_SECONDS):
+        raw = mne.io.read_raw_fif(raw_path, preload=True, verbose=False)
+        self.board_id = None
+        self.brainflow_board = ReplayShim(raw, speed, use_recorded_markers)
+        self._channel_names = [name for name in raw.ch_names if name != STIM_CHAN_NAME]
+        self._init_buffers(buffer_seconds)
+
+    @property
+    def eeg_channels(self):
+        return list(range(len(self._channel_names)))
+
+    @property
+    def sfreq(self):
+        return self.brainflow_board.sfreq
+
+    @property
+    def marker_channel(self):
+        return len(self._channel_names)
+
+    @property
+    def channel_names(self):
+        return list(self._channel_names)
+
+    @property
+    def finished(self):
+        return self.brainflow_board.finished
+
+
+REPLAY_CHUNK_SECONDS = 0.1
+
+
+class ReplayShim:
+    """
+    The part of BrainFlow's BoardShim used by Board, serving the samples of a raw (in uV like BrainFlow, eeg channels
+    then the marker channel) as they become available according to the replay speed
+    """
+
+    def __init__(self, raw, speed, use_recorded_markers):
+        self.sfreq = int(raw.info["sfreq"])
+        eeg = raw.get_data(picks="eeg") * 1e6
+        markers = raw.get_data(picks=[STIM_CHAN_NAME]) if use_recorded_markers else np.zeros((1, eeg.shape[1]))
+        self.data = np.concatenate([eeg, markers])
+        self.speed = speed
+        self.use_recorded_markers = use_recorded_markers
+        self.chunk = int(REPLAY_CHUNK_SECONDS * self.sfreq)
+        self._start_time = None
+        self._n_released = 0
+        self._n_consumed = 0  # samples removed by get_board_data
+
+    def prepare_session(self):
+        pass
+
+    def config_board(self, msg):
+        pass
+
+    def start_stream(self):
+        self._start_time = time.perf_counter()
+
+    def stop_stream(self):
+        pass
+
+    def release_session(self):
+        pass
+
+    def log_message(self, level, msg):
+        pass
+
+    @property
+    def finished(self):
+        return self._n_released >= self.data.shape[1]
+
+    def _release(self):
+        # samples are only released when the count is polled (or all the data is taken), so a count and the following
+        # read see the same samples
+        if self._start_time is None:
+            return
+        if self.speed:
+            n_samples = int((time.perf_counter() - self._start_time) * self.sfreq * self.speed)
+        else:
+            n_samples = self._n_released + self.chunk
+        self._n_released = min(max(n_samples, self._n_released), self.data.shape[1])
+
+    def get_board_data_count(self):
+        self._release()
+        return self._n_released - self._n_consumed
+
+    def get_current_board_data(self, n_samples):
+        end = self._n_released
+        return self.data[:, max(end - n_samples, self._n_consumed):end].copy()
+
+    def get_board_data(self):
+        self._release()
+        data = self.data[:, self._n_consumed:self._n_released].copy()
+        self._n_consumed = self._n_released
+        return data
+
+    def insert_marker(self, marker):
+        if not self.use_recorded_markers and not self.finished:
+            self.data[-1, self._n_released] = marker
 
-        # create mne raw object
-        raw = mne.io.RawArray(data, info)
-        raw.set_montage("standard_1020")
 
-        return raw
+def create_board(params):
+    """
+    Board described by the recording params: a ReplayBoard of the recording folder params["replay"] if set, otherwise
+    the synthetic or the real board
+    """
+    if params.get("replay"):
+        return ReplayBoard(os.path.join(RECORDINGS_DIR, params["replay"], "raw.fif"), params.get("replay_speed", 1))
+    return Board(use_synthetic=params["use_synthetic_board"])
 
 
 def find_serial_port():
@@ -0,0 +1,192 @@
+"""
+Local index of the recordings, pipelines and hyperparams saved on disk, so they can be queried by subject, date,
+pipeline name and params without listing and parsing folder names every time.
+The data_utils save functions add their files to the catalog. Files added by other means (e.g. pulled from git) are
+picked up by rescanning a folder whenever its modification time changed.
+"""
+import json
+import os
+import re
+import sqlite3
+from contextlib import closing
+
+from constants import *
+
+PIPELINE_NAMES = ["spectral", "csp"]
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}--\d{2}-\d{2}-\d{2}$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (folder TEXT PRIMARY KEY, subject TEXT, date TEXT, params TEXT);
+CREATE TABLE IF NOT EXISTS pipelines (file TEXT PRIMARY KEY, subject TEXT, date TEXT, pipeline TEXT);
+CREATE TABLE IF NOT EXISTS hyperparams (file TEXT PRIMARY KEY, subject TEXT, date TEXT, pipeline TEXT, params TEXT);
+CREATE TABLE IF NOT EXISTS scanned_dirs (dir TEXT PRIMARY KEY, mtime REAL);
+CREATE INDEX IF NOT EXISTS recordings_subject ON recordings (subject, date);
+CREATE INDEX IF NOT EXISTS pipelines_subject ON pipelines (subject, pipeline, date);
+CREATE INDEX IF NOT EXISTS hyperparams_subject ON hyperparams (subject, pipeline, date);
+"""
+
+
+def connect(catalog_path=CATALOG_PATH):
+    conn = sqlite3.connect(catalog_path)
+    conn.executescript(SCHEMA)
+    with conn:
+        sync(conn)
+    return conn
+
+
+def add_recording(folder, params, conn=None):
+    date, subject = parse_dated_name(folder)
+    execute("INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, ?)", (folder, subject, date, json.dumps(params)), conn)
+
+
+def add_pipeline(file, conn=None):
+    date, subject, pipeline = parse_file_name(file, "_pipeline.npz" if file.endswith(".npz") else "_pipeline.pickle")
+    execute("INSERT OR REPLACE INTO pipelines VALUES (?, ?, ?, ?)", (file, subject, date, pipeline), conn)
+
+
+def add_hyperparams(file, hyperparams, conn=None):
+    date, subject, pipeline = parse_file_name(file, "_hyperparams.json")
+    execute("INSERT OR REPLACE INTO hyperparams VALUES (?, ?, ?, ?, ?)",
+            (file, subject, date, pipeline, json.dumps(hyperparams)), conn)
+
+
+def find_recordings(subject=None, start_date=None, end_date=None, **params):
+    """
+    Recording folders sorted by date. Dates are datestrings or prefixes of them (e.g. "2022-05-17"), both ends are
+    inclusive. params filter by the recording params, e.g. find_recordings(use_synthetic_board=False).
+    """
+    conditions, args = date_conditions(start_date, end_date)
+    if subject is not None:
+        conditions.append("subject = ?")
+        args.append(subject)
+    for key, value in params.items():
+        conditions.append("json_extract(params, ?) = ?")
+        args += [f'$.{key}', value]
+    return query_files("recordings", "folder", conditions, args)
+
+
+def find_pipelines(subject=None, pipeline=None, start_date=None, end_date=None):
+    """
+    Pipeline files sorted by date, files saved without a date (old naming) come first.
+    """
+    conditions, args = subject_conditions(subject, pipeline)
+    date_conds, date_args = date_conditions(start_date, end_date)
+    return query_files("pipelines", "file", conditions + date_conds, args + date_args)
+
+
+def find_hyperparams(subject=None, pipeline=None, start_date=None, end_date=None):
+    """
+    Hyperparams files sorted by date.
+    """
+    conditions, args = subject_conditions(subject, pipeline)
+    date_conds, date_args = date_conditions(start_date, end_date)
+    return query_files("hyperparams", "file", conditions + date_conds, args + date_args)
+
+
+def subject_conditions(subject, pipeline):
+    conditions, args = [], []
+    if subject is not None:
+        conditions.append("subject = ?")
+        args.append(subject)
+    if pipeline is not None:
+        conditions.append("pipeline = ?")
+        args.append(pipeline)
+    return conditions, args
+
+
+def date_conditions(start_date, end_date):
+    conditions, args = [], []
+    if start_date is not None:
+        conditions.append("date >= ?")
+        args.append(start_date)
+    if end_date is not None:
+        conditions.append("substr(date, 1, length(?)) <= ?")
+        args += [end_date, end_date]
+    return conditions, args
+
+
+def query_files(table, column, conditions, args):
+    where = f' WHERE {" AND ".join(conditions)}' if conditions else ""
+    with closing(connect()) as conn:
+        rows = conn.execute(f'SELECT {column} FROM {table}{where} ORDER BY date, {column}', args).fetchall()
+    return [row[0] for row in rows]
+
+
+def execute(sql, args, conn=None):
+    if conn is not None:
+        conn.execute(sql, args)
+        return
+    with closing(connect()) as conn, conn:
+        conn.execute(sql, args)
+
+
+def sync(conn):
+    """
+    Rescan the folders that changed since they were last scanned
+    """
+    sync_dir(conn, RECORDINGS_DIR, "recordings", "folder", index_recording_folder)
+    sync_dir(conn, PIPELINES_DIR, "pipelines", "file", index_pipeline_file)
+    sync_dir(conn, HYPERPARAMS_DIR, "hyperparams", "file", index_hyperparams_file)
+
+
+def sync_dir(conn, dir_path, table, column, index_entry):
+    if not os.path.isdir(dir_path):
+        return
+    mtime = os.stat(dir_path).st_mtime
+    row = conn.execute("SELECT mtime FROM scanned_dirs WHERE dir = ?", (dir_path,)).fetchone()
+    if row is not None and row[0] == mtime:
+        return
+
+    entries = set(os.listdir(dir_path))
+    indexed = {row[0] for row in conn.execute(f'SELECT {column} FROM {table}')}
+    for entry in indexed - entries:
+        conn.execute(f'DELETE FROM {table} WHERE {column} = ?', (entry,))
+    for entry in entries - indexed:
+        index_entry(conn, dir_path, entry)
+    conn.execute("INSERT OR REPLACE INTO scanned_dirs VALUES (?, ?)", (dir_path, mtime))
+
+
+def index_recording_folder(conn, dir_path, folder):
+    params_path = os.path.join(dir_path, folder, "params.json")
+    # sessions being recorded (or that crashed before being finalized) have no raw.fif yet
+    if parse_dated_name(folder)[0] is None or not os.path.exists(params_path) or not os.path.exists(
+            os.path.join(dir_path, folder, "raw.fif")):
+        return
+    with open(params_path) as file:
+        add_recording(folder, json.load(file), conn)
+
+
+def index_pipeline_file(conn, dir_path, file):
+    if file.endswith(".pickle") or file.endswith(".npz"):
+        add_pipeline(file, conn)
+
+
+def index_hyperparams_file(conn, dir_path, file):
+    if file.endswith("_hyperparams.json"):
+        with open(os.path.join(dir_path, file)) as f:
+            add_hyperparams(file, json.load(f), conn)
+
+
+def parse_dated_name(name):
+    """
+    "<date>_<rest>" => (date, rest), the rest may contain underscores.
+    Names without a leading datestring (older naming) give (None, rest)
+    """
+    date, _, rest = name.partition("_")
+    if DATE_PATTERN.match(date):
+        return date, rest
+    return None, rest
+
+
+def parse_file_name(file, suffix):
+    """
+    "<date>_<subject>[_<pipeline>]<suffix>" => (date, subject, pipeline), the subject may contain underscores.
+    Older pipeline files are named "pipeline_<subject>.pickle".
+    """
+    if file.startswith("pipeline_") and file.endswith(".pickle"):
+        return None, file[len("pipeline_"):-len(".pickle")], None
+    date, rest = parse_dated_name(file[:-len(suffix)] if file.endswith(suffix) else file)
+    subject, _, pipeline = rest.rpartition("_")
+    if subject and pipeline in PIPELINE_NAMES:
+        return date, subject, pipeline
+    return date, rest, None
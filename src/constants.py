@@ -4,3 +4,7 @@ RECORDINGS_DIR = "../recordings"
 RECORDING_PARAMS_PATH = "../recording_params.json"
 PIPELINES_DIR = "../pipelines"
 HYPERPARAMS_DIR = "../hyperparams"
+CACHE_DIR = "../cache"
+CATALOG_PATH = "../catalog.sqlite"
+BENCHMARKS_DIR = "../benchmarks"
+TRIALS_PATH = "../trials.sqlite"
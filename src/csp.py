@@ -1,32 +1,46 @@
 from sklearn.pipeline import Pipeline
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
-from preprocessing import laplacian
+from preprocessing import laplacian, cached_filter_data
 import mne
 import numpy as np
 from pipeline import show_pipeline_steps
 from skopt.space import Real, Integer
+from incremental import IncrementalCSP, IncrementalLDA
 
 name = "csp"
 
 
 class Preprocessor:
+    stateless = True
+
     def __init__(self):
         self.epoch_tmin = 1
         self.l_freq = 7
         self.h_freq = 30
         self.do_laplacian = True
-
-    def set_params(self, epoch_tmin, l_freq, h_freq, do_laplacian):
-        self.epoch_tmin = epoch_tmin
-        self.l_freq = l_freq
-        self.h_freq = h_freq
-        self.do_laplacian = do_laplacian
+        self.filter_bank = None
+
+    def set_params(self, epoch_tmin=None, l_freq=None, h_freq=None, do_laplacian=None, filter_bank=None):
+        if epoch_tmin is not None:
+            self.epoch_tmin = epoch_tmin
+        if l_freq is not None:
+            self.l_freq = l_freq
+        if h_freq is not None:
+            self.h_freq = h_freq
+        if do_laplacian is not None:
+            self.do_laplacian = do_laplacian
+        if filter_bank is not None:
+            self.filter_bank = filter_bank
 
     def fit(self, data, labels):
         return self
 
     def transform(self, epochs):
-        epochs = mne.filter.filter_data(epochs, 125, self.l_freq, self.h_freq, verbose=False)
+        if self.filter_bank is not None:
+            # in filter bank mode we get indices of epochs in the bank instead of the epochs themselves
+            epochs = self.filter_bank.get(epochs, self.l_freq, self.h_freq)
+        else:
+            epochs = cached_filter_data(epochs, 125, self.l_freq, self.h_freq)
         epochs = epochs[:, :, int(125 * self.epoch_tmin):]
         if self.do_laplacian:
             epochs = laplacian(epochs)
@@ -36,37 +50,78 @@ class Preprocessor:
 class CSP_features:
     def __init__(self):
         self.CSP = mne.decoding.CSP(transform_into="csp_space")
-
-    def set_params(self, n_components, **kwargs):
-        self.CSP = mne.decoding.CSP(n_components=n_components, transform_into="csp_space")
+        self.incremental = False
+
+    def set_params(self, n_components, incremental=False, **kwargs):
+        """
+        incremental: use IncrementalCSP, so the pipeline can be updated with new epochs only (see
+        pipeline.partial_fit_pipeline)
+        """
+        if incremental:
+            if kwargs.get('entropy'):
+                raise ValueError("entropy features can't be computed incrementally")
+            self.CSP = IncrementalCSP(n_components=n_components)
+        else:
+            self.CSP = mne.decoding.CSP(n_components=n_components, transform_into="csp_space")
+        self.incremental = incremental
         self.params = kwargs
         print()
 
     def fit(self, data, labels):
+        if self.incremental:
+            self.epoch_scatters, self.epoch_means, self.labels = [], [], []
+            self.CSP = IncrementalCSP(n_components=self.CSP.n_components)
+            return self.partial_fit(data, labels)
         self.CSP.fit(data, labels)
         return self
 
+    def partial_fit(self, data, labels):
+        """
+        Update the CSP with new epochs only, the covariance of every epoch is kept so the features of all the epochs
+        seen so far can be recomputed when the CSP filters change (see fitted_features). Unlike the spectral pipeline,
+        whose updates take the same time at any point, recomputing the features grows linearly with the number of
+        epochs seen (by an (n_channels, n_channels) product per epoch).
+        """
+        self.CSP.partial_fit(data, labels)
+        self.epoch_scatters.append(np.einsum("ect,edt->ecd", data, data))
+        self.epoch_means.append(data.mean(axis=2))
+        self.labels.append(labels)
+        self.n_times = data.shape[2]
+        return self
+
+    def fitted_features(self):
+        """
+        Features and labels of every epoch seen by fit/partial_fit, using the current CSP filters. None until epochs of
+        two classes were seen.
+        """
+        if self.CSP.filters_ is None:
+            return None
+        filters = self.CSP.filters_[:self.CSP.n_components]
+        total_power = np.einsum("kc,ecd,kd->ek", filters, np.concatenate(self.epoch_scatters), filters)
+        means = np.concatenate(self.epoch_means) @ filters.T
+        var = total_power / self.n_times - means ** 2
+        return self._features(total_power, var, self.n_times), np.concatenate(self.labels)
+
     def transform(self, epochs):
         components = self.CSP.transform(epochs)
-        features = []
         power = components ** 2
+        entropy = (power * np.log(power)).sum(axis=2) if self.params.get('entropy') else None
+        return self._features(power.sum(axis=2), np.var(components, axis=2), components.shape[2], entropy)
+
+    def _features(self, total_power, var, n_times, entropy=None):
+        features = []
         if not self.params.get('total_power') and not self.params.get('log_mean_power') and not self.params.get(
                 'entropy') and not self.params.get('var'):
-            return power.sum(axis=2)
+            return total_power
         if self.params.get('total_power'):
-            total_power = power.sum(axis=2)
             features.append(total_power)
         if self.params.get('log_mean_power'):
-            log_mean_power = np.log10(power.mean(axis=2))
+            log_mean_power = np.log10(total_power / n_times)
             features.append(log_mean_power)
         if self.params.get('entropy'):
-            entropy = (power * np.log(power)).sum(axis=2)
             features.append(entropy)
         if self.params.get('var'):
-            var_sum = np.sum(np.stack([np.var(components[:, i, :], axis=1) for i in range(components.shape[1])]),
-                             axis=0)
-            var = np.stack([np.var(components[:, i, :], axis=1) / var_sum for i in range(components.shape[1])], axis=1)
-            features.append(np.log(var))
+            features.append(np.log(var / var.sum(axis=1, keepdims=True)))
         features = np.concatenate(features, axis=1)
         return features
 
@@ -83,8 +138,15 @@ bayesian_search_space = {
     "csp__var": [True, False],
 }
 
+# In filter bank mode l_freq and h_freq are snapped to this grid, see pipeline.filter_bank_search
+filter_bank_l_freqs = [1, 2, 4, 6, 8, 10, 12, 14]
+filter_bank_h_freqs = [15, 20, 25, 30, 35, 40, 45, 50]
+
 
-def create_pipeline(hyperparams=None, model=LinearDiscriminantAnalysis):
+def create_pipeline(hyperparams=None, model=LinearDiscriminantAnalysis, incremental=False):
+    """
+    incremental: create a pipeline that can be updated with new epochs only, using pipeline.partial_fit_pipeline
+    """
     default_hyperparams = {
         "csp__log_mean_power": True,
         "csp__total_power": False,
@@ -100,6 +162,9 @@ def create_pipeline(hyperparams=None, model=LinearDiscriminantAnalysis):
         hyperparams = {**default_hyperparams, **hyperparams}
     else:
         hyperparams = default_hyperparams
+    if incremental:
+        hyperparams = {**hyperparams, "csp__incremental": True}
+        model = IncrementalLDA
 
     pipeline = Pipeline(
         [('preprocessing', Preprocessor()), ('csp', CSP_features()), ('model', model())])
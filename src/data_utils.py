@@ -5,9 +5,15 @@ from constants import *
 from pathlib import Path
 from tkfilebrowser import askopendirnames
 import mne
+import numpy as np
 import pickle
+import catalog
+from model_artifact import export_pipeline, load_artifact, save_artifact
 
 SYNTHETIC_SUBJECT_NAME = "Synthetic"
+EPOCHS_FILE = "epochs.npy"
+LABELS_FILE = "labels.npy"
+EPOCHS_PARAMS_FILE = "epochs.json"
 
 
 def now_datestring():
@@ -18,9 +24,19 @@ def save_raw(raw, rec_params):
     folder_path = create_session_folder(rec_params['subject'])
     raw.save(os.path.join(folder_path, "raw.fif"))
     json_dump(rec_params, os.path.join(folder_path, "params.json"))
+    catalog.add_recording(os.path.basename(folder_path), rec_params)
     return os.path.basename(folder_path)
 
 
+def start_session_folder(rec_params):
+    """
+    Create the folder of a session that is about to be recorded (see session_writer), with its params
+    """
+    folder_path = create_session_folder(rec_params['subject'])
+    json_dump(rec_params, os.path.join(folder_path, "params.json"))
+    return folder_path
+
+
 def create_session_folder(subj):
     folder_name = f'{now_datestring()}_{subj}'
     folder_path = os.path.join(RECORDINGS_DIR, folder_name)
@@ -46,63 +62,118 @@ def get_file_date(filename):
 
 
 def get_subject_rec_folders(subj):
-    all_recs = os.listdir(RECORDINGS_DIR)
-    subj_recs = [rec for rec in all_recs if rec.split("_")[-1] == subj]
-    return subj_recs
+    return catalog.find_recordings(subject=subj)
 
 
-def load_recordings(subj="", choose=False):
+def get_recent_rec_folders(subj="", choose=False):
     """
-    Load all the recordings, all from the most recent day.
+    Folders of all the recordings of the subject from the most recent day (or the ones chosen in a dialog).
     """
     if choose:
-        subj_recs_recent = askopendirnames(initialdir=RECORDINGS_DIR)
-    else:
-        print(f'Loading recordings for subject {subj}...')
-        subj_recs = get_subject_rec_folders(subj)
+        return askopendirnames(initialdir=RECORDINGS_DIR)
+
+    print(f'Loading recordings for subject {subj}...')
+    subj_recs = get_subject_rec_folders(subj)
+
+    if len(subj_recs) == 0:
+        raise ValueError(f'No recordings found for subject: {subj}')
 
-        if len(subj_recs) == 0:
-            raise ValueError(f'No recordings found for subject: {subj}')
+    most_recent_rec_date = get_file_date(subj_recs[-1])
+    subj_recs_recent = [rec for rec in subj_recs if get_file_date(rec) == most_recent_rec_date]
 
-        most_recent_rec_date = get_file_date(sorted(subj_recs)[-1])
-        subj_recs_recent = [rec for rec in subj_recs if get_file_date(rec) == most_recent_rec_date]
+    if len(subj_recs_recent) != len(subj_recs):
+        print(f'There are recordings taken from multiple days, using the most recent {most_recent_rec_date}')
+    return subj_recs_recent
 
-        if len(subj_recs_recent) != len(subj_recs):
-            print(f'There are recordings taken from multiple days, using the most recent {most_recent_rec_date}')
 
+def load_recording_params(rec_folder):
+    return json_load(os.path.join(RECORDINGS_DIR, rec_folder, 'params.json'))
+
+
+def load_recordings(subj="", choose=False):
+    """
+    Load all the recordings, all from the most recent day.
+    """
+    subj_recs_recent = get_recent_rec_folders(subj, choose)
     raws = [load_recording(rec) for rec in subj_recs_recent]
 
     # When multiple recordings are loaded, the recording_params.json is taken from the first recording
-    with open(os.path.join(RECORDINGS_DIR, subj_recs_recent[0], 'params.json')) as file:
-        rec_params = json.load(file)
+    rec_params = load_recording_params(subj_recs_recent[0])
 
     return raws, rec_params
 
 
-def save_pipeline(pipeline, subject):
-    save_path = os.path.join(PIPELINES_DIR, f'{now_datestring()}_{subject}_pipeline.pickle')
-    pickle_dump(pipeline, save_path)
+def save_epochs(rec_folder, epochs, labels, epochs_params):
+    """
+    Save the epochs of a recording next to its raw.fif, so they can be loaded without epoching the raw again.
+    epochs_params are the params the epochs were created with, the store is only used with the same params.
+    """
+    folder_path = os.path.join(RECORDINGS_DIR, rec_folder)
+    params_path = os.path.join(folder_path, EPOCHS_PARAMS_FILE)
+    # the params file is written last and marks the store as complete
+    if os.path.exists(params_path):
+        os.remove(params_path)
+    np.save(os.path.join(folder_path, EPOCHS_FILE), epochs)
+    np.save(os.path.join(folder_path, LABELS_FILE), labels)
+    json_dump(epochs_params, params_path)
+
+
+def load_epochs(rec_folder, epochs_params):
+    """
+    Load the stored epochs of a recording as a read-only memmap (the data is only read from disk when used).
+    Returns None if there are no stored epochs or they were created with different params.
+    """
+    folder_path = os.path.join(RECORDINGS_DIR, rec_folder)
+    params_path = os.path.join(folder_path, EPOCHS_PARAMS_FILE)
+    if not os.path.exists(params_path) or json_load(params_path) != epochs_params:
+        return None
+    epochs = np.load(os.path.join(folder_path, EPOCHS_FILE), mmap_mode="r")
+    labels = np.load(os.path.join(folder_path, LABELS_FILE))
+    return epochs, labels
+
+
+def save_pipeline(pipeline, subject, name=None):
+    """
+    Save a fitted pipeline as a model artifact (see model_artifact), pipelines that can't be exported (e.g. with
+    models other than LDA) are pickled instead.
+    name: the type of the pipeline, one of ["spectral", "csp"]
+    """
+    try:
+        model, suffix = export_pipeline(pipeline), "_pipeline.npz"
+    except ValueError as e:
+        print(f'{e}, pickling the pipeline instead')
+        model, suffix = None, "_pipeline.pickle"
+    file_name = f'{now_datestring()}_{subject}_{name}{suffix}' if name else f'{now_datestring()}_{subject}{suffix}'
+    if model is None:
+        pickle_dump(pipeline, os.path.join(PIPELINES_DIR, file_name))
+    else:
+        save_artifact(model, os.path.join(PIPELINES_DIR, file_name), name)
+    catalog.add_pipeline(file_name)
 
 
-def load_pipeline(subj):
-    all_pipelines = os.listdir(PIPELINES_DIR)
-    subj_pipelines = sorted([p for p in all_pipelines if p.split("_")[1] == f"{subj}.pickle"])
+def load_pipeline(subj, name=None):
+    """
+    The most recent pipeline of the subject, an InferenceModel if it was saved as a model artifact
+    """
+    subj_pipelines = catalog.find_pipelines(subject=subj, pipeline=name)
+    if len(subj_pipelines) == 0:
+        raise ValueError(f'No pipelines found for subject: {subj}')
     latest_pipeline = subj_pipelines[-1]
     load_path = os.path.join(PIPELINES_DIR, latest_pipeline)
+    if latest_pipeline.endswith(".npz"):
+        return load_artifact(load_path)
     return pickle_load(load_path)
 
 
 def save_hyperparams(hyperparams, subject, pipeline):
-    save_path = os.path.join(HYPERPARAMS_DIR, f'{now_datestring()}_{pipeline}_{subject}_hyperparams.json')
-    json_dump(hyperparams, save_path)
+    file_name = f'{now_datestring()}_{subject}_{pipeline}_hyperparams.json'
+    json_dump(hyperparams, os.path.join(HYPERPARAMS_DIR, file_name))
+    catalog.add_hyperparams(file_name, hyperparams)
 
 
 def load_hyperparams(subject, pipeline):
     print(f'Loading hyperparams for subject {subject} and pipeline {pipeline}...')
-    all_hyperparams = os.listdir(HYPERPARAMS_DIR)
-    subj_hyperparams = sorted(
-        [p for p in all_hyperparams if (p.split("_")[1] == subject and p.split("_")[2] == pipeline)]
-    )
+    subj_hyperparams = catalog.find_hyperparams(subject=subject, pipeline=pipeline)
 
     if len(subj_hyperparams) == 0:
         print(f'No hyperparams found for subject {subject}')
@@ -1,2 +1,25 @@
 import numpy as np
-from mne_features.univariate import compute_pow_freq_bands
+from mne_features.utils import power_spectrum
+
+
+def pow_freq_bands(sfreq, epochs, freq_bands, normalize=True, psd_params=None):
+    """
+    Batched equivalent of mne_features' compute_pow_freq_bands.
+    Runs welch once over the whole (n_epochs, n_channels, n_times) array and integrates all the bands with a single
+    matrix product, returns an array of shape (n_epochs, n_channels * n_bands) ordered like compute_pow_freq_bands.
+    """
+    psd_params = psd_params or {}
+    bands = np.asarray([freq_bands[band] for band in freq_bands], dtype=float).reshape(-1, 2)
+    if not np.logical_and(bands >= 0, bands <= sfreq / 2).all():
+        raise ValueError(f'Frequency bands {bands.tolist()} must be positive and less than the Nyquist frequency')
+
+    psd, freqs = power_spectrum(sfreq, epochs, psd_method="welch", **psd_params)
+
+    # (n_freqs, n_bands) 0/1 matrix, band edges are inclusive like in mne_features
+    band_mask = np.logical_and(freqs[:, None] >= bands[:, 0], freqs[:, None] <= bands[:, 1]).astype(psd.dtype)
+    band_power = psd @ band_mask
+
+    if normalize:
+        band_power /= psd.sum(axis=-1, keepdims=True)
+
+    return band_power.reshape(len(epochs), -1)
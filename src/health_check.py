@@ -1,31 +1,169 @@
-from board import Board
-from recording import load_rec_params
+from board import create_board
+from data_utils import load_rec_params
 import matplotlib.pyplot as plt
 import numpy as np
-import scipy.signal
-import scipy.stats
 import mne
-from preprocessing import get_average_corr
+import queue
+import threading
+import time
+from health_metrics import HealthMetrics, StreamingPSD, chan_metrics, chan_errors, latest_window
+
+
+MAX_FPS = 30
+ACQUISITION_RATE = MAX_FPS  # Hz, rate at which the worker produces frames
+FRAME_QUEUE_SIZE = 2
+STATS_INTERVAL = 5  # seconds between monitor stats reports
 
 
 def health_check():
     rec_params = load_rec_params()
     window_size = 2
-    with Board(use_synthetic=rec_params["use_synthetic_board"]) as board:
+    with create_board(rec_params) as board:
         plt.ion()
         ax = create_figure(len(board.eeg_channels))
         chan_plots = plot_chans(board.channel_names, window_size, ax)
         montage_plot, chan_error_texts = plot_montage(board.channel_names, ax["upright"])
         psd_plots = plot_psd(ax["upright"], board.channel_names)
-        while True:
-            data = get_next_data(board, window_size)
-            fs = board.sfreq
-            errors_by_chan = check_chan_health(data)
-            update_chan_plots(chan_plots, data, window_size)
-            update_montage_plot(montage_plot, errors_by_chan, chan_error_texts)
-            update_psd_plot(psd_plots, data, fs)
-            plt.draw()
-            plt.pause(1e-3)
+        blitter = Blitter(ax[0].figure, chan_plots + psd_plots + [montage_plot] + chan_error_texts)
+
+        frames = queue.Queue(maxsize=FRAME_QUEUE_SIZE)
+        stop = threading.Event()
+        stats = MonitorStats()
+        worker = threading.Thread(target=acquire_frames, args=(board, window_size, frames, stop, stats), daemon=True)
+        worker.start()
+        try:
+            while plt.fignum_exists(blitter.fig.number):
+                frame_start = time.perf_counter()
+                try:
+                    frame = frames.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if isinstance(frame, Exception):
+                    raise RuntimeError("Acquiring the health frames failed") from frame
+                update_chan_plots(chan_plots, frame["data"], window_size)
+                update_montage_plot(montage_plot, frame["errors_by_chan"], chan_error_texts)
+                update_psd_plot(psd_plots, frame["freqs"], frame["psd"])
+                blitter.update()
+                stats.displayed(time.perf_counter() - frame["time"])
+                # cap the frame rate, the worker keeps acquiring meanwhile
+                time.sleep(max(0.0, 1 / MAX_FPS - (time.perf_counter() - frame_start)))
+        finally:
+            stop.set()
+            worker.join()
+
+
+def acquire_frames(board, window_size, frames, stop, stats):
+    """
+    Worker thread: reads new samples, updates the health metrics and puts frames in the (bounded) frames queue.
+    If the display falls behind the oldest frame is dropped, so the display always shows the latest data.
+    An exception stops the worker and is put in the queue instead of a frame, to be raised by the display.
+    """
+    try:
+        metrics = HealthMetrics(len(board.eeg_channels), board.sfreq)
+        psd = StreamingPSD(len(board.eeg_channels), board.sfreq)
+        while not stop.is_set():
+            acquired = time.perf_counter()
+            n_samples = board.ring_buffer.n_samples
+            data = latest_window(board, window_size, metrics)
+            if board.ring_buffer.n_samples == n_samples:
+                stats.stalled()
+            with board.lock:
+                psd.follow(board.ring_buffer, channels=slice(0, -1), scale=1e6)
+            frame = {
+                "time": acquired,
+                "data": data,
+                "errors_by_chan": chan_errors(chan_metrics(metrics, data)),
+                "freqs": psd.freqs,
+                "psd": psd.psd,
+            }
+            put_latest(frames, frame, stats)
+            time.sleep(max(0.0, 1 / ACQUISITION_RATE - (time.perf_counter() - acquired)))
+    except Exception as e:
+        put_latest(frames, e, stats)
+
+
+def put_latest(frames, frame, stats):
+    while True:
+        try:
+            frames.put_nowait(frame)
+            return
+        except queue.Full:
+            try:
+                frames.get_nowait()
+                stats.dropped()
+            except queue.Empty:
+                pass
+
+
+class Blitter:
+    """
+    Redraws only the given (animated) artists over a cached background of the rest of the figure.
+    The background is recaptured whenever the figure is fully redrawn (e.g. on resize).
+    """
+
+    def __init__(self, fig, artists):
+        self.fig = fig
+        self.artists = artists
+        self.background = None
+        for artist in artists:
+            artist.set_animated(True)
+        fig.canvas.mpl_connect("draw_event", self.on_draw)
+        plt.show(block=False)
+        plt.pause(0.1)
+
+    def on_draw(self, event):
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in self.artists:
+            self.fig.draw_artist(artist)
+
+    def update(self):
+        canvas = self.fig.canvas
+        if self.background is None:
+            self.on_draw(None)
+        else:
+            canvas.restore_region(self.background)
+            self.draw_artists()
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+
+
+class MonitorStats:
+    """
+    Displayed and dropped frames, frames without new samples (the stream stalled) and display latency (from
+    acquisition to the frame being on screen), printed every STATS_INTERVAL seconds
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.n_dropped = 0
+        self.n_stalled = 0
+        self.latencies = []
+        self.last_report = time.perf_counter()
+
+    def dropped(self):
+        with self.lock:
+            self.n_dropped += 1
+
+    def stalled(self):
+        with self.lock:
+            self.n_stalled += 1
+
+    def displayed(self, latency):
+        self.latencies.append(latency)
+        elapsed = time.perf_counter() - self.last_report
+        if elapsed < STATS_INTERVAL:
+            return
+        with self.lock:
+            n_dropped, self.n_dropped = self.n_dropped, 0
+            n_stalled, self.n_stalled = self.n_stalled, 0
+        latencies = np.array(self.latencies) * 1000
+        print(f'{len(latencies) / elapsed:.1f} fps, {n_dropped} dropped frames, {n_stalled} frames without new '
+              f'samples, latency: mean {latencies.mean():.1f} ms, max {latencies.max():.1f} ms')
+        self.latencies = []
+        self.last_report = time.perf_counter()
 
 
 def plot_psd(ax, chan_names):
@@ -42,12 +180,11 @@ def plot_psd(ax, chan_names):
     return chan_lines
 
 
-def update_psd_plot(psd_plots, data, sfreq):
-    pass
-    for plot, chan in zip(psd_plots, data):
-        # print("Plot {p} and Chan {c}".format(p=plot, c=chan))
-        freq, power = scipy.signal.welch(chan, sfreq, nperseg=sfreq, scaling="density")
-        plot.set_data(freq, 10 * np.log10(power))
+def update_psd_plot(psd_plots, freqs, psd):
+    if psd is None:
+        return
+    for plot, power in zip(psd_plots, psd):
+        plot.set_data(freqs, 10 * np.log10(power))
 
 
 def on_press(event):
@@ -112,34 +249,5 @@ def update_montage_plot(montage_plot, errors_by_chan, chan_error_texts):
         chan_error_text.set_text("\n".join(errors))
 
 
-def get_next_data(board, window_size):
-    channels = board.eeg_channels
-    n_samples = board.sfreq * window_size
-    data = board.brainflow_board.get_current_board_data(n_samples)
-    data = data[channels]
-    for i, chan in enumerate(data):
-        data[i] = chan - np.mean(chan)  # DC Offset
-    return data
-
-
-def check_chan_health(data):
-    errors_by_chan = {}
-    for i, chan in enumerate(data):
-        if len(chan):
-            avg_corr = get_average_corr(chan, data)
-            max = np.max(np.abs(chan))
-            errors = []
-            if np.abs(avg_corr) < 0.05:
-                errors.append("avg corr too low")
-            elif np.abs(avg_corr) > 0.9:
-                errors.append("avg corr too high")
-            if max > 300:
-                errors.append("amplitude too high")
-            elif max < 10:
-                errors.append("amplitude too low")
-            errors_by_chan[i] = errors
-    return errors_by_chan
-
-
 if __name__ == "__main__":
     health_check()
@@ -0,0 +1,156 @@
+"""
+Headless electrode health monitoring: the health_check metrics of every channel of a board, published as JSON lines to
+a file (or stdout) or as UDP datagrams, so rigs can be monitored without a display.
+Runs standalone (python health_daemon.py, configured by the recording params) or as a thread next to run_session.
+"""
+import json
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from board import create_board
+from data_utils import load_rec_params
+from health_metrics import HealthMetrics, chan_metrics, chan_errors, latest_window
+
+HEALTH_RATE = 1  # Hz, rate at which metrics are published
+HEALTH_WINDOW = 2  # seconds of data the metrics are computed over
+
+
+class HealthPublisher:
+    """
+    Thread publishing the health metrics of a board at a fixed rate. Only the samples recorded since the last update
+    are processed (see health_metrics.HealthMetrics), so it can run continuously during a session.
+    """
+
+    def __init__(self, board, writer, rate=HEALTH_RATE, window_size=HEALTH_WINDOW):
+        self.board = board
+        self.writer = writer
+        self.rate = rate
+        self.window_size = window_size
+        self.metrics = HealthMetrics(len(board.eeg_channels), board.sfreq)
+        self.host = socket.gethostname()
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the thread and close the writer, an error of the thread is left for check
+        """
+        self._stop.set()
+        self._thread.join()
+        self.writer.close()
+
+    def check(self):
+        """
+        Raise the error that stopped publishing, if any
+        """
+        if self.error is not None:
+            raise RuntimeError("Publishing the electrode health failed") from self.error
+
+    def run(self):
+        next_time = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                self.writer.write(json.dumps(self.health_record()))
+                next_time += 1 / self.rate
+                self._stop.wait(max(0.0, next_time - time.perf_counter()))
+        except Exception as e:
+            # kept for check, an exception in the thread would otherwise only be printed
+            self.error = e
+
+    def health_record(self):
+        data = latest_window(self.board, self.window_size, self.metrics)
+        values = chan_metrics(self.metrics, data)
+        errors_by_chan = chan_errors(values)
+        channels = [{
+            "name": name,
+            "avg_corr": json_float(values["avg_corr"][i]),
+            "max_amp": json_float(values["max_amp"][i]),
+            "line_noise": json_float(values["line_noise"][i]),
+            "errors": errors_by_chan[i],
+        } for i, name in enumerate(self.board.channel_names)]
+        return {"time": time.time(), "host": self.host, "n_samples": int(self.metrics.n_samples),
+                "channels": channels}
+
+
+def json_float(value):
+    # json has no NaN, metrics are NaN until there is enough data
+    return None if np.isnan(value) else round(float(value), 4)
+
+
+class LineWriter:
+    """
+    Writes lines to a target: "udp://<host>:<port>" sends every line as a datagram, "-" writes to stdout and anything
+    else is a file path lines are appended to.
+    """
+
+    def __init__(self, target):
+        self.sock = None
+        self.file = None
+        if target.startswith("udp://"):
+            host, port = target[len("udp://"):].rsplit(":", 1)
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.address = (host, int(port))
+        else:
+            self.file = sys.stdout if target == "-" else open(target, "a")
+
+    def write(self, line):
+        if self.sock is not None:
+            self.sock.sendto(line.encode(), self.address)
+        else:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        elif self.file is not sys.stdout:
+            self.file.close()
+
+
+def start_health_publisher(board, params):
+    """
+    Start publishing the health of board if the params have a "health_stream" target, returns the publisher or None
+    """
+    if not params.get("health_stream"):
+        return None
+    return HealthPublisher(board, LineWriter(params["health_stream"]), params.get("health_rate", HEALTH_RATE)).start()
+
+
+@contextmanager
+def health_publishing(board, params):
+    """
+    start_health_publisher for the duration of the block, the publisher is stopped even if the block fails
+    """
+    publisher = start_health_publisher(board, params)
+    try:
+        yield publisher
+    finally:
+        if publisher:
+            publisher.stop()
+
+
+def run_health_daemon(params):
+    with create_board(params) as board:
+        publisher = HealthPublisher(board, LineWriter(params.get("health_stream") or "-"),
+                                    params.get("health_rate", HEALTH_RATE))
+        try:
+            publisher.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            publisher.writer.close()
+        publisher.check()
+
+
+if __name__ == "__main__":
+    run_health_daemon(load_rec_params())
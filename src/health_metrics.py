@@ -0,0 +1,223 @@
+import numpy as np
+import scipy.signal
+
+LINE_FREQ = 50  # Hz, power line frequency
+CORR_LOW = 0.05
+CORR_HIGH = 0.9
+AMP_HIGH = 300  # uV
+AMP_LOW = 10  # uV
+LINE_NOISE_HIGH = 0.5  # fraction of the channel's power at the line frequency
+PSD_SMOOTHING = 0.3
+
+
+class HealthMetrics:
+    """
+    Health metrics of all the channels of a sliding window of samples: the channel correlation matrix, and the power at
+    the line frequency (a single DFT bin).
+    Only the samples that enter and leave the window are processed on update, so the cost of a refresh doesn't depend
+    on the window size.
+    """
+
+    def __init__(self, n_channels, sfreq, line_freq=LINE_FREQ):
+        self.n_channels = n_channels
+        self.omega = 2 * np.pi * line_freq / sfreq
+        self.reset()
+
+    def reset(self, first_idx=0):
+        self.n_samples = 0
+        self._offset = None  # sums are of (samples - offset), so large dc offsets don't cost precision
+        self._sum = np.zeros(self.n_channels)
+        self._cross = np.zeros((self.n_channels, self.n_channels))
+        self._line = np.zeros(self.n_channels, dtype=complex)  # sum of x[n] * exp(-i * omega * n)
+        self._phasor_sum = 0j  # sum of exp(-i * omega * n), to remove the mean from the line bin
+        self._first_idx = first_idx  # index of the oldest sample in the window
+        self._next_idx = first_idx  # index of the next sample to be added
+
+    def update(self, new_samples, removed_samples=None):
+        """
+        new_samples: (n_channels, n_new) samples that entered the window.
+        removed_samples: (n_channels, n_removed) oldest samples that left the window (oldest first).
+        """
+        if removed_samples is not None and removed_samples.shape[1]:
+            self._accumulate(removed_samples, self._first_idx, -1)
+            self._first_idx += removed_samples.shape[1]
+        if new_samples.shape[1]:
+            self._accumulate(new_samples, self._next_idx, 1)
+            self._next_idx += new_samples.shape[1]
+
+    def follow(self, ring_buffer, n_samples, channels=slice(None), scale=1):
+        """
+        Slide the window to the latest n_samples of a board.RingBuffer, only the samples appended since the last call
+        and the ones that left the window are processed.
+        channels: rows of the buffer to use, scale: factor applied to the samples (e.g. 1e6 for V => uV)
+        """
+        stop = ring_buffer.n_samples
+        start = max(stop - n_samples, 0)
+        removed = ring_buffer.get(self._first_idx, min(start, self._next_idx))
+        if removed is None or start > self._next_idx:
+            # the previous window is gone (not followed for too long), start over
+            self.reset(start)
+        elif removed.shape[1]:
+            self._accumulate(removed[channels] * scale, self._first_idx, -1)
+            self._first_idx = start
+        new = ring_buffer.get(self._next_idx, stop)
+        if new.shape[1]:
+            self._accumulate(new[channels] * scale, self._next_idx, 1)
+            self._next_idx = stop
+
+    def _accumulate(self, samples, first_idx, sign):
+        if self._offset is None:
+            self._offset = samples.mean(axis=1)
+        shifted = samples - self._offset[:, np.newaxis]
+        phasors = np.exp(-1j * self.omega * np.arange(first_idx, first_idx + samples.shape[1]))
+        self.n_samples += sign * samples.shape[1]
+        self._sum += sign * shifted.sum(axis=1)
+        self._cross += sign * (shifted @ shifted.T)
+        self._line += sign * (shifted @ phasors)
+        self._phasor_sum += sign * phasors.sum()
+
+    @property
+    def mean(self):
+        return self._offset + self._sum / self.n_samples
+
+    @property
+    def cov(self):
+        shifted_mean = self._sum / self.n_samples
+        return self._cross / self.n_samples - np.outer(shifted_mean, shifted_mean)
+
+    @property
+    def var(self):
+        return np.maximum(np.diag(self.cov), 0)
+
+    def corr(self):
+        std = np.sqrt(self.var)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corr = self.cov / np.outer(std, std)
+        return np.nan_to_num(corr, nan=0.0, posinf=0.0, neginf=0.0)
+
+    def average_corr(self):
+        """
+        Average correlation of every channel with the other channels
+        """
+        if self.n_channels < 2:
+            return np.zeros(self.n_channels)
+        corr = self.corr()
+        return (corr.sum(axis=1) - np.diag(corr)) / (self.n_channels - 1)
+
+    def line_noise(self):
+        """
+        Fraction of the power of every channel that is at the line frequency
+        """
+        line = self._line - (self._sum / self.n_samples) * self._phasor_sum
+        line_power = 2 * np.abs(line) ** 2 / self.n_samples ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.nan_to_num(line_power / self.var)
+
+
+def latest_window(board, window_size, metrics):
+    """
+    Latest window of eeg data of a board.Board in uV without its DC offset. metrics are moved along to the same window,
+    processing only the samples that entered and left it.
+    """
+    n_samples = board.sfreq * window_size
+    with board.lock:
+        board.update()
+        metrics.follow(board.ring_buffer, n_samples, channels=slice(0, -1), scale=1e6)
+        data = board.ring_buffer.latest(n_samples)[:-1] * 1e6
+    if metrics.n_samples:
+        data -= metrics.mean[:, np.newaxis]  # DC Offset
+    return data
+
+
+def chan_metrics(metrics, data):
+    """
+    Health metrics of every channel, from the metrics of a window and the window itself (n_channels, n_samples) in uV,
+    without its DC offset
+    """
+    if metrics.n_samples < 2:
+        nan = np.full(len(data), np.nan)
+        return {"avg_corr": nan, "max_amp": nan, "line_noise": nan}
+    return {
+        "avg_corr": metrics.average_corr(),
+        "max_amp": np.abs(data).max(axis=1),
+        "line_noise": metrics.line_noise(),
+    }
+
+
+def chan_errors(values):
+    """
+    Errors of every channel, from its chan_metrics
+    """
+    errors_by_chan = {}
+    for i, (avg_corr, max_amp, line_noise) in enumerate(zip(np.abs(values["avg_corr"]), values["max_amp"],
+                                                            values["line_noise"])):
+        errors = []
+        if avg_corr < CORR_LOW:
+            errors.append("avg corr too low")
+        elif avg_corr > CORR_HIGH:
+            errors.append("avg corr too high")
+        if max_amp > AMP_HIGH:
+            errors.append("amplitude too high")
+        elif max_amp < AMP_LOW:
+            errors.append("amplitude too low")
+        if line_noise > LINE_NOISE_HIGH:
+            errors.append("line noise")
+        errors_by_chan[i] = errors
+    return errors_by_chan
+
+
+class StreamingPSD:
+    """
+    Welch PSD (hann window, 50% overlap, constant detrend and density scaling, like scipy.signal.welch) of a stream,
+    where the segments are averaged exponentially instead of over a fixed window.
+    Only segments completed by newly arrived samples are processed, so the cost of a refresh doesn't depend on how much
+    data the estimate covers.
+    """
+
+    def __init__(self, n_channels, sfreq, nperseg=None, smoothing=PSD_SMOOTHING):
+        """
+        smoothing: weight of every new segment in the running average
+        """
+        self.n_channels = n_channels
+        self.nperseg = int(nperseg or sfreq)
+        self.step = self.nperseg - self.nperseg // 2
+        self.smoothing = smoothing
+        self.freqs = np.fft.rfftfreq(self.nperseg, 1 / sfreq)
+        self.window = scipy.signal.get_window("hann", self.nperseg)
+        self.scale = np.full(len(self.freqs), 2 / (sfreq * (self.window ** 2).sum()))
+        self.scale[0] /= 2
+        if self.nperseg % 2 == 0:
+            self.scale[-1] /= 2
+        self.psd = None
+        self._next_seg = 0  # index of the first sample of the next segment
+
+    def follow(self, ring_buffer, channels=slice(None), scale=1):
+        """
+        Average in the segments of a board.RingBuffer completed since the last call.
+        channels: rows of the buffer to use, scale: factor applied to the samples (e.g. 1e6 for V => uV)
+        """
+        stop = ring_buffer.n_samples
+        n_segments = (stop - self._next_seg - self.nperseg) // self.step + 1
+        if n_segments <= 0:
+            return
+        if ring_buffer.get(self._next_seg, stop) is None:
+            # segments were overwritten before being processed, continue from the latest ones
+            self._next_seg = stop - ring_buffer.capacity
+            n_segments = (stop - self._next_seg - self.nperseg) // self.step + 1
+        data = ring_buffer.get(self._next_seg, self._next_seg + self.nperseg + (n_segments - 1) * self.step)
+        segments = np.lib.stride_tricks.sliding_window_view(data[channels] * scale, self.nperseg, axis=1)[:,
+                   ::self.step]
+        self.update(segments.transpose(1, 0, 2))
+        self._next_seg += n_segments * self.step
+
+    def update(self, segments):
+        """
+        segments: (n_segments, n_channels, nperseg), oldest first
+        """
+        segments = segments - segments.mean(axis=2, keepdims=True)
+        periodograms = np.abs(np.fft.rfft(segments * self.window, axis=2)) ** 2 * self.scale
+        for periodogram in periodograms:
+            if self.psd is None:
+                self.psd = periodogram
+            else:
+                self.psd = self.smoothing * periodogram + (1 - self.smoothing) * self.psd
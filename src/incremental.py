@@ -0,0 +1,135 @@
+import numpy as np
+import scipy.linalg
+from mne.decoding.csp import _ajd_pham
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+
+class ClassStats:
+    """
+    Running sufficient statistics (number of samples, sum and scatter matrix) of the samples of every class.
+    Updating with new samples costs O(n_new * n_dims²), solving from the statistics doesn't depend on how many
+    samples were seen.
+    """
+
+    def __init__(self):
+        self.classes = []
+        self.counts = {}
+        self.sums = {}
+        self.scatters = {}
+
+    def update(self, samples, labels):
+        """
+        samples: (n_samples, n_dims), labels: (n_samples,)
+        """
+        for label in np.unique(labels):
+            class_samples = samples[labels == label]
+            if label not in self.counts:
+                self.classes = sorted(self.classes + [label])
+                self.counts[label] = 0
+                self.sums[label] = np.zeros(samples.shape[1])
+                self.scatters[label] = np.zeros((samples.shape[1], samples.shape[1]))
+            self.counts[label] += len(class_samples)
+            self.sums[label] += class_samples.sum(axis=0)
+            self.scatters[label] += class_samples.T @ class_samples
+
+    def mean(self, label):
+        return self.sums[label] / self.counts[label]
+
+    def cov(self, label, ddof=0):
+        mean = self.mean(label)
+        count = self.counts[label]
+        return (self.scatters[label] - count * np.outer(mean, mean)) / (count - ddof)
+
+
+class IncrementalLDA(BaseEstimator, ClassifierMixin):
+    """
+    Linear discriminant analysis (shared covariance, same solution as sklearn's lsqr solver) that can be updated with
+    new samples using partial_fit, without keeping the samples seen before.
+    """
+
+    def fit(self, X, y):
+        self.stats_ = ClassStats()
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X, y):
+        if not hasattr(self, "stats_"):
+            self.stats_ = ClassStats()
+        self.stats_.update(np.asarray(X, dtype=float), np.asarray(y))
+        self._solve()
+        return self
+
+    def _solve(self):
+        stats = self.stats_
+        self.classes_ = np.array(stats.classes)
+        counts = np.array([stats.counts[label] for label in stats.classes])
+        self.priors_ = counts / counts.sum()
+        self.means_ = np.array([stats.mean(label) for label in stats.classes])
+        self.covariance_ = sum(prior * stats.cov(label) for prior, label in zip(self.priors_, stats.classes))
+        self.coef_ = scipy.linalg.lstsq(self.covariance_, self.means_.T)[0].T
+        self.intercept_ = -0.5 * np.sum(self.means_ * self.coef_, axis=1) + np.log(self.priors_)
+
+    def decision_function(self, X):
+        return np.asarray(X) @ self.coef_.T + self.intercept_
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.decision_function(X), axis=1)]
+
+
+class IncrementalCSP:
+    """
+    CSP (as mne.decoding.CSP with the default concatenated covariance, transform_into="csp_space") computed from running
+    class covariance statistics, so partial_fit only processes the new epochs and re-solving costs O(n_channels³).
+    The filters are only solved once epochs of two classes were seen, filters_ is None until then.
+    """
+
+    def __init__(self, n_components=4):
+        self.n_components = n_components
+        self.stats = ClassStats()
+        self.filters_ = None
+
+    def fit(self, epochs, labels):
+        self.stats = ClassStats()
+        return self.partial_fit(epochs, labels)
+
+    def partial_fit(self, epochs, labels):
+        # every time sample of an epoch is a sample of the class covariance
+        n_epochs, n_channels, n_times = epochs.shape
+        samples = epochs.transpose(0, 2, 1).reshape(-1, n_channels)
+        self.stats.update(samples, np.repeat(labels, n_times))
+        if len(self.stats.classes) > 1:
+            self._solve()
+        return self
+
+    def _solve(self):
+        # np.cov normalization, and the same weight for every class, like mne
+        covs = np.array([self.stats.cov(label, ddof=1) for label in self.stats.classes])
+        if len(covs) < 2:
+            raise ValueError("CSP needs epochs of at least two classes")
+        if len(covs) == 2:
+            eigen_values, eigen_vectors = scipy.linalg.eigh(covs[0], covs.sum(axis=0))
+            ix = np.argsort(np.abs(eigen_values - 0.5))[::-1]
+        else:
+            eigen_vectors, _ = _ajd_pham(covs)
+            eigen_vectors = normalize_eigenvectors(eigen_vectors.T, covs)
+            ix = np.argsort(mutual_info(eigen_vectors, covs))[::-1]
+        self.filters_ = eigen_vectors[:, ix].T
+
+    def transform(self, epochs):
+        if self.filters_ is None:
+            raise ValueError("CSP needs epochs of at least two classes")
+        return np.einsum("kc,ect->ekt", self.filters_[:self.n_components], epochs)
+
+
+def normalize_eigenvectors(eigen_vectors, covs):
+    mean_cov = covs.mean(axis=0)
+    scale = np.sqrt(np.einsum("ck,cd,dk->k", eigen_vectors, mean_cov, eigen_vectors))
+    return eigen_vectors / scale
+
+
+def mutual_info(eigen_vectors, covs):
+    # approximation of the mutual information between each component and the classes (Grosse-Wentrup 2008)
+    class_probas = np.full(len(covs), 1 / len(covs))
+    projected = np.einsum("ck,ncd,dk->nk", eigen_vectors, covs, eigen_vectors)
+    aa = class_probas @ np.log(np.sqrt(projected))
+    bb = class_probas @ (projected ** 2 - 1)
+    return -(aa + (3.0 / 16) * (bb ** 2))
@@ -0,0 +1,170 @@
+"""
+Inference runtime for online prediction, built from a fitted pipeline or a loaded model artifact (see model_artifact).
+For a given epoch length the zero phase FIR filter (with its edge padding) and the crop are a linear map of the
+samples, so they're precomputed as one matrix and fused with the spatial and CSP filters: an epoch goes through a
+matrix product on each side, then the features and the linear classifier. The band powers of the spectral pipeline are
+computed the same way, from the DFT bins inside the bands only (the window is folded into the DFT matrix) and the total
+power of every welch segment.
+Like model_artifact, only numpy is needed to run a loaded artifact.
+"""
+import numpy as np
+
+from model_artifact import WELCH_MAX_N_FFT, CSPFeatures, InferenceModel, export_pipeline, fir_filter
+
+
+class InferenceRuntime:
+    """
+    Predictions of single epochs (n_channels, n_times) or batches of them (n_epochs, n_channels, n_times), the same
+    as the model's. The operators of every epoch length seen are compiled on first use and kept.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.preprocessor, self.feature_step, self.classifier = [step for _, step in model.steps]
+        self.is_csp = isinstance(self.feature_step, CSPFeatures)
+        # channel mixing applied before the temporal filter (they commute), the CSP filters include the spatial filter
+        self.channels = self.preprocessor.spatial
+        if self.is_csp:
+            self.channels = self.feature_step.filters if self.channels is None else \
+                self.feature_step.filters @ self.channels
+        self._temporal = {}
+        self._band_powers = {}
+
+    def temporal(self, n_times):
+        """
+        (n_times, n_cropped) matrix, epoch @ temporal is the filtered and cropped epoch
+        """
+        if n_times not in self._temporal:
+            # the rows are the filter's responses to every sample, the padding is linear in the samples too
+            self._temporal[n_times] = np.ascontiguousarray(
+                fir_filter(np.eye(n_times), self.preprocessor.fir)[:, self.preprocessor.start:])
+        return self._temporal[n_times]
+
+    def band_powers(self, n_times):
+        """
+        The welch plans of the parts of the epochs after and before the feature step's start sample
+        """
+        if n_times not in self._band_powers:
+            step = self.feature_step
+            # the segment length is capped to the imagination part, then to the calibration part, like FeatureExtractor
+            n_per_seg = min(step.n_per_seg, n_times - step.start)
+            imagination = BandPowerPlan(step, n_times - step.start, n_per_seg)
+            calibration = BandPowerPlan(step, step.start, min(n_per_seg, step.start))
+            self._band_powers[n_times] = imagination, calibration
+        return self._band_powers[n_times]
+
+    def features(self, epochs):
+        epochs = np.asarray(epochs, dtype=float)
+        single = epochs.ndim == 2
+        if single:
+            epochs = epochs[np.newaxis]
+        if self.channels is not None:
+            epochs = self.channels @ epochs
+        filtered = epochs @ self.temporal(epochs.shape[-1])
+        if self.is_csp:
+            features = self.feature_step.features(filtered)
+        else:
+            start = self.feature_step.start
+            imagination, calibration = self.band_powers(filtered.shape[-1])
+            band_power = imagination.transform(filtered[..., start:])
+            features = np.concatenate((band_power, calibration.transform(filtered[..., :start]) / band_power), axis=1)
+        return features[0] if single else features
+
+    def decision_function(self, epochs):
+        features = self.features(epochs)
+        return self.classifier.decision_function(np.atleast_2d(features))
+
+    def predict_features(self, features):
+        """
+        The prediction for the features of one epoch (or the predictions of a batch)
+        """
+        if np.ndim(features) == 1:
+            return self.classifier.predict(features[np.newaxis])[0]
+        return self.classifier.predict(features)
+
+    def predict(self, epochs):
+        return self.predict_features(self.features(epochs))
+
+
+class BandPowerPlan:
+    """
+    Normalized welch band powers of epochs of n_times samples, as model_artifact.BandPowerFeatures computes them.
+    The psd scaling cancels out in the normalization, so only the DFT bins in the bands and the total power of every
+    segment are computed: with the periodic hamming window and the mean removal folded into the DFT matrix, and the
+    total from Parseval's theorem.
+    """
+
+    def __init__(self, feature_step, n_times, n_per_seg):
+        n_fft = min(n_times, WELCH_MAX_N_FFT)
+        n_overlap = int(n_per_seg * feature_step.n_overlap)
+        step = n_per_seg - n_overlap
+        n_segments = (n_times - n_overlap) // step
+        self.segment_indices = np.arange(n_segments)[:, None] * step + np.arange(n_per_seg)
+        self.window = 0.54 - 0.46 * np.cos(2 * np.pi * np.arange(n_per_seg) / n_per_seg)
+        self.remove_dc = feature_step.remove_dc
+
+        freqs = np.arange(n_fft // 2 + 1) * (feature_step.sfreq / n_fft)
+        bands = feature_step.bands
+        band_mask = np.logical_and(freqs[:, None] >= bands[:, 0], freqs[:, None] <= bands[:, 1])
+        bins = np.flatnonzero(band_mask.any(axis=1))
+        # one-sided psd: every bin but 0 and (for an even n_fft) nyquist counts twice
+        weights = np.where((bins == 0) | (2 * bins == n_fft), 1.0, 2.0)
+        self.band_mask = band_mask[bins] * weights[:, None]
+        # segment @ window is the windowed (and de-meaned) segment
+        window = (np.eye(n_per_seg) - 1 / n_per_seg) * self.window if self.remove_dc else np.diag(self.window)
+        angles = 2 * np.pi * np.outer(np.arange(n_per_seg), bins) / n_fft
+        self.dft = window @ np.concatenate((np.cos(angles), np.sin(angles)), axis=1)
+        self.n_bins = len(bins)
+        self.n_fft = n_fft
+
+    def transform(self, epochs):
+        segments = epochs[..., self.segment_indices]  # (n_epochs, n_channels, n_segments, n_per_seg)
+        spectrum = segments @ self.dft
+        power = spectrum[..., :self.n_bins] ** 2 + spectrum[..., self.n_bins:] ** 2
+        band_power = (power @ self.band_mask).sum(axis=2)
+        # sum of the two-sided power spectrum = n_fft * energy of the windowed segment
+        window_sq = self.window ** 2
+        energy = (segments ** 2) @ window_sq
+        if self.remove_dc:
+            mean = segments.mean(axis=-1)
+            energy += mean ** 2 * window_sq.sum() - 2 * mean * (segments @ window_sq)
+        band_power /= self.n_fft * energy.sum(axis=2)[..., None]
+        return band_power.reshape(len(epochs), -1)
+
+
+class PipelineRuntime:
+    """
+    Same interface as InferenceRuntime, for pipelines that can't be exported (with models other than LDA)
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def features(self, epochs):
+        from pipeline import transform_steps  # imports mne, only needed for these pipelines
+
+        epochs = np.asarray(epochs)
+        if epochs.ndim == 2:
+            return transform_steps(self.pipeline.steps[:-1], epochs[np.newaxis])[0]
+        return transform_steps(self.pipeline.steps[:-1], epochs)
+
+    def predict_features(self, features):
+        if np.ndim(features) == 1:
+            return self.pipeline[-1].predict(features[np.newaxis])[0]
+        return self.pipeline[-1].predict(features)
+
+    def predict(self, epochs):
+        return self.predict_features(self.features(epochs))
+
+
+def create_runtime(pipeline):
+    """
+    The runtime of a fitted pipeline or an InferenceModel, it has to be created again when the pipeline is refitted
+    """
+    if isinstance(pipeline, InferenceModel):
+        return InferenceRuntime(pipeline)
+    try:
+        return InferenceRuntime(export_pipeline(pipeline))
+    except ValueError as e:
+        print(f'{e}, predicting with the pipeline')
+        return PipelineRuntime(pipeline)
@@ -0,0 +1,54 @@
+import os
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+SPANS_FILE = "latency_spans.csv"
+SUMMARY_FILE = "latency_summary.csv"
+PERCENTILES = [50, 95, 99]
+
+
+class TrialSpans:
+    """
+    Timing of the stages of every trial of an online session (fetching the epoch, feature extraction, prediction,
+    rendering the feedback, retraining...), saved to the session folder with a percentiles summary
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.t0 = time.perf_counter()
+
+    @contextmanager
+    def span(self, trial, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(trial, name, start, time.perf_counter())
+
+    def add(self, trial, name, start, end):
+        """
+        start, end: time.perf_counter() values
+        """
+        self.rows.append((trial, name, start - self.t0, end - start))
+
+    def to_frame(self):
+        spans = pd.DataFrame(self.rows, columns=["trial", "span", "start_s", "duration_ms"])
+        spans["duration_ms"] *= 1000
+        return spans
+
+    def summary(self):
+        durations = self.to_frame().groupby("span", sort=False)["duration_ms"]
+        summary = pd.DataFrame({f'p{p}': durations.quantile(p / 100) for p in PERCENTILES})
+        summary.insert(0, "count", durations.count())
+        summary["max"] = durations.max()
+        return summary
+
+    def save(self, folder_path):
+        if not self.rows:
+            return
+        self.to_frame().to_csv(os.path.join(folder_path, SPANS_FILE), index=False, float_format="%.3f")
+        summary = self.summary()
+        summary.to_csv(os.path.join(folder_path, SUMMARY_FILE), float_format="%.3f")
+        print(f'Latency per stage (ms):\n{summary.round(1)}')
@@ -0,0 +1,310 @@
+"""
+Model artifacts: the learned arrays of a fitted spectral or csp pipeline (FIR filter coefficients, spatial filters,
+CSP filters, frequency bands, classifier weights) and a versioned json header, in a single .npz file.
+Loading an artifact only needs numpy and gives an InferenceModel that predicts like the pipeline it was exported
+from. Only numpy is imported at module level, export_pipeline imports what it needs when it's called.
+"""
+import datetime
+import json
+import platform
+
+import numpy as np
+
+FORMAT = "bci-pipeline"
+FORMAT_VERSION = 1
+HEADER_KEY = "header"
+SFREQ = 125  # the pipelines filter and compute features at this rate
+WELCH_MAX_N_FFT = 512
+
+
+class FIRPreprocessor:
+    """
+    Zero phase FIR band-pass (same output as mne.filter.filter_data with its default FIR design), then the epochs are
+    cropped to start at sample start, and an optional spatial filter (e.g. a laplacian) is applied
+    """
+    arrays = ["fir", "spatial"]
+
+    def __init__(self, fir, start=0, spatial=None):
+        self.fir = np.asarray(fir, dtype=float)
+        self.start = start
+        self.spatial = spatial
+
+    def params(self):
+        return {"start": self.start}
+
+    def transform(self, epochs):
+        epochs = fir_filter(np.asarray(epochs, dtype=float), self.fir)[..., self.start:]
+        if self.spatial is not None:
+            epochs = np.einsum("kc,ect->ekt", self.spatial, epochs)
+        return epochs
+
+
+class BandPowerFeatures:
+    """
+    spectral.FeatureExtractor: welch band powers of the epochs after (and before) sample start, and their ratios
+    """
+    arrays = ["bands"]
+
+    def __init__(self, bands, start, n_per_seg, n_overlap, sfreq=SFREQ, remove_dc=False):
+        self.bands = np.asarray(bands, dtype=float)
+        self.start = start
+        self.n_per_seg = n_per_seg
+        self.n_overlap = n_overlap
+        self.sfreq = sfreq
+        self.remove_dc = remove_dc
+
+    def params(self):
+        return {"start": self.start, "n_per_seg": self.n_per_seg, "n_overlap": self.n_overlap, "sfreq": self.sfreq,
+                "remove_dc": self.remove_dc}
+
+    def transform(self, epochs):
+        # the segment length is capped to the imagination part, then to the calibration part, like FeatureExtractor
+        n_per_seg = min(self.n_per_seg, epochs.shape[-1] - self.start)
+        band_power = self._band_power(epochs[..., self.start:], n_per_seg)
+        n_per_seg = min(n_per_seg, self.start)
+        band_power_calib = self._band_power(epochs[..., :self.start], n_per_seg)
+        return np.concatenate((band_power, band_power_calib / band_power), axis=1)
+
+    def _band_power(self, epochs, n_per_seg):
+        # features.pow_freq_bands with mne's psd_array_welch (periodic hamming window, mean of the segments)
+        n_fft = min(epochs.shape[-1], WELCH_MAX_N_FFT)
+        psd, freqs = welch(epochs, self.sfreq, n_fft, n_per_seg, int(n_per_seg * self.n_overlap), self.remove_dc)
+        band_mask = np.logical_and(freqs[:, None] >= self.bands[:, 0], freqs[:, None] <= self.bands[:, 1])
+        band_power = psd @ band_mask.astype(psd.dtype)
+        band_power /= psd.sum(axis=-1, keepdims=True)
+        return band_power.reshape(len(epochs), -1)
+
+
+class CSPFeatures:
+    """
+    csp.CSP_features: powers of the epochs projected on the CSP filters
+    """
+    arrays = ["filters"]
+
+    def __init__(self, filters, total_power=False, log_mean_power=False, entropy=False, var=False):
+        self.filters = np.asarray(filters, dtype=float)
+        self.total_power = total_power
+        self.log_mean_power = log_mean_power
+        self.entropy = entropy
+        self.var = var
+
+    def params(self):
+        return {"total_power": self.total_power, "log_mean_power": self.log_mean_power, "entropy": self.entropy,
+                "var": self.var}
+
+    def transform(self, epochs):
+        return self.features(np.einsum("kc,ect->ekt", self.filters, epochs))
+
+    def features(self, components):
+        """
+        The features of epochs already projected on the filters, shape (n_epochs, n_components, n_times)
+        """
+        power = components ** 2
+        total_power = power.sum(axis=2)
+        if not (self.total_power or self.log_mean_power or self.entropy or self.var):
+            return total_power
+        features = []
+        if self.total_power:
+            features.append(total_power)
+        if self.log_mean_power:
+            features.append(np.log10(total_power / components.shape[2]))
+        if self.entropy:
+            features.append((power * np.log(power)).sum(axis=2))
+        if self.var:
+            var = np.var(components, axis=2)
+            features.append(np.log(var / var.sum(axis=1, keepdims=True)))
+        return np.concatenate(features, axis=1)
+
+
+class LinearClassifier:
+    """
+    LDA decision function and predictions: the class with the highest score (or the sign of the score for two classes)
+    """
+    arrays = ["coef", "intercept", "classes"]
+
+    def __init__(self, coef, intercept, classes):
+        self.coef = np.asarray(coef, dtype=float)
+        self.intercept = np.asarray(intercept, dtype=float)
+        self.classes = np.asarray(classes)
+
+    @property
+    def classes_(self):
+        return self.classes
+
+    def params(self):
+        return {}
+
+    def decision_function(self, X):
+        scores = np.asarray(X) @ self.coef.T + self.intercept
+        return scores.ravel() if scores.shape[1] == 1 else scores
+
+    def predict(self, X):
+        scores = self.decision_function(X)
+        if scores.ndim == 1:
+            return self.classes[(scores > 0).astype(int)]
+        return self.classes[np.argmax(scores, axis=1)]
+
+
+STEP_TYPES = {step_type.__name__: step_type for step_type in [FIRPreprocessor, BandPowerFeatures, CSPFeatures,
+                                                               LinearClassifier]}
+
+
+class InferenceModel:
+    """
+    A fitted pipeline reduced to numpy steps. Indexed like an sklearn Pipeline, e.g. model[:-1].transform(epochs)
+    gives the features and model[-1].predict(features) the predictions
+    """
+
+    def __init__(self, steps, header=None):
+        self.steps = steps
+        self.header = header or {}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return InferenceModel(self.steps[index], self.header)
+        return self.steps[index][1]
+
+    @property
+    def classes_(self):
+        return self[-1].classes_
+
+    def transform(self, epochs):
+        for _, step in self.steps:
+            epochs = step.transform(epochs)
+        return epochs
+
+    def decision_function(self, epochs):
+        return self[-1].decision_function(self[:-1].transform(epochs))
+
+    def predict(self, epochs):
+        return self[-1].predict(self[:-1].transform(epochs))
+
+    def score(self, epochs, labels):
+        return float(np.mean(self.predict(epochs) == np.asarray(labels)))
+
+
+def save_artifact(model, path, pipeline_name=None):
+    header = {
+        "format": FORMAT,
+        "version": FORMAT_VERSION,
+        "pipeline": pipeline_name or model.header.get("pipeline"),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "exported_with": {"python": platform.python_version(), "numpy": np.__version__},
+        "steps": [{"name": name, "type": type(step).__name__, "params": step.params()} for name, step in model.steps],
+    }
+    arrays = {}
+    for name, step in model.steps:
+        for key in step.arrays:
+            value = getattr(step, key)
+            if value is not None:
+                arrays[f'{name}.{key}'] = np.asarray(value)
+    with open(path, "wb") as file:
+        np.savez(file, **{HEADER_KEY: np.array(json.dumps(header))}, **arrays)
+
+
+def load_artifact(path):
+    """
+    The InferenceModel stored in an artifact, artifacts of newer format versions are rejected
+    """
+    with np.load(path, allow_pickle=False) as data:
+        header = json.loads(str(data[HEADER_KEY]))
+        if header.get("format") != FORMAT:
+            raise ValueError(f'{path} is not a pipeline artifact')
+        if header["version"] > FORMAT_VERSION:
+            raise ValueError(f'{path} has format version {header["version"]}, this code reads up to {FORMAT_VERSION}')
+        steps = []
+        for step in header["steps"]:
+            step_type = STEP_TYPES[step["type"]]
+            arrays = {key: data[f'{step["name"]}.{key}'] for key in step_type.arrays if
+                      f'{step["name"]}.{key}' in data}
+            steps.append((step["name"], step_type(**arrays, **step["params"])))
+    return InferenceModel(steps, header)
+
+
+def export_pipeline(pipe):
+    """
+    InferenceModel of a fitted spectral or csp pipeline. Raises ValueError if the pipeline has steps that can't be
+    exported. Only LDA models are supported: other models with coef_ don't predict the class with the highest
+    decision function (e.g. a linear SVC is one-vs-one).
+    """
+    import inspect
+    from mne.filter import create_filter
+    from mne.time_frequency import psd_array_welch
+    from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+    from incremental import IncrementalLDA
+    from preprocessing import laplacian
+
+    names = [name for name, _ in pipe.steps]
+    if names not in (["preprocessing", "feature_extraction", "model"], ["preprocessing", "csp", "model"]):
+        raise ValueError(f'Pipelines with steps {names} can\'t be exported')
+    preprocessor, features, model = [step for _, step in pipe.steps]
+    if type(model) not in (LinearDiscriminantAnalysis, IncrementalLDA):
+        raise ValueError(f'{type(model).__name__} models can\'t be exported, only LDA models')
+
+    if names[1] == "csp":
+        pipeline_name = "csp"
+        filters = features.CSP.filters_[:features.CSP.n_components]
+        n_channels = filters.shape[1]
+        start = int(SFREQ * preprocessor.epoch_tmin)
+        feature_step = CSPFeatures(filters, **{key: bool(features.params.get(key)) for key in
+                                               ["total_power", "log_mean_power", "entropy", "var"]})
+    else:
+        pipeline_name = "spectral"
+        bands = [features.freq_bands[band] for band in features.freq_bands]
+        n_channels = model.coef_.shape[1] // (2 * len(bands))
+        start = 0
+        # newer mne versions remove the mean of every welch segment
+        remove_dc = inspect.signature(psd_array_welch).parameters.get("remove_dc")
+        feature_step = BandPowerFeatures(bands, int(features.epoch_tmin * SFREQ), features.n_per_seg,
+                                         features.n_overlap, remove_dc=bool(remove_dc and remove_dc.default))
+
+    fir = create_filter(None, SFREQ, preprocessor.l_freq, preprocessor.h_freq, verbose=False)
+    # the laplacian is linear in the channels, so it's the matrix it maps the identity to
+    spatial = laplacian(np.eye(n_channels)[None])[0] if preprocessor.do_laplacian else None
+    steps = [
+        ("preprocessing", FIRPreprocessor(fir, start, spatial)),
+        (names[1], feature_step),
+        ("model", LinearClassifier(np.atleast_2d(model.coef_), np.atleast_1d(model.intercept_), model.classes_)),
+    ]
+    return InferenceModel(steps, {"pipeline": pipeline_name})
+
+
+def fir_filter(x, fir):
+    """
+    Zero phase filtering of the last axis of x with an odd length, linear phase FIR, padded like mne's overlap-add
+    filtering (odd reflection of the edges, limited to the signal length)
+    """
+    n_times, n_fir = x.shape[-1], len(fir)
+    n_edge = max(min(n_fir, n_times) - 1, 0)
+    pad_shape = x.shape[:-1]
+    padded = np.concatenate([
+        np.zeros(pad_shape + (max(n_edge - n_times + 1, 0),)),
+        2 * x[..., :1] - x[..., n_edge:0:-1],
+        x,
+        2 * x[..., -1:] - x[..., -2:-n_edge - 2:-1],
+        np.zeros(pad_shape + (max(n_edge - n_times + 1, 0),)),
+    ], axis=-1)
+    n_conv = padded.shape[-1] + n_fir - 1
+    n_fft = 1 << (n_conv - 1).bit_length()
+    filtered = np.fft.irfft(np.fft.rfft(padded, n_fft) * np.fft.rfft(fir, n_fft), n_fft)
+    shift = (n_fir - 1) // 2 + n_edge
+    return filtered[..., shift:shift + n_times]
+
+
+def welch(x, sfreq, n_fft, n_per_seg, n_overlap, remove_dc=False):
+    """
+    One-sided welch power spectral density of the last axis of x with a periodic hamming window and the mean over the
+    segments (as mne.time_frequency.psd_array_welch). remove_dc: subtract the mean of every segment
+    """
+    window = 0.54 - 0.46 * np.cos(2 * np.pi * np.arange(n_per_seg) / n_per_seg)
+    step = n_per_seg - n_overlap
+    n_segments = (x.shape[-1] - n_overlap) // step
+    starts = np.arange(n_segments) * step
+    segments = x[..., starts[:, None] + np.arange(n_per_seg)]
+    if remove_dc:
+        segments = segments - segments.mean(axis=-1, keepdims=True)
+    segments = segments * window
+    psd = np.abs(np.fft.rfft(segments, n_fft)) ** 2 / (sfreq * (window ** 2).sum())
+    psd[..., 1:n_fft - n_fft // 2] *= 2  # the nyquist bin (even n_fft) isn't doubled
+    # computed like mne does, band edges can fall exactly on a frequency
+    return psd.mean(axis=-2), np.arange(n_fft // 2 + 1) * (sfreq / n_fft)
@@ -1,18 +1,30 @@
+import importlib
 import mne
 from Marker import Marker
 from sklearn.model_selection import RepeatedStratifiedKFold, cross_validate
 import numpy as np
 from sklearn.model_selection import GridSearchCV
-from data_utils import load_recordings
-from skopt import BayesSearchCV
+from data_utils import load_recordings, load_recording, load_epochs, save_epochs
+from joblib import Parallel, delayed
+from skopt.space import Categorical
+from preprocessing import create_filter_bank
+from shared_epochs import share_epochs
+from contextlib import contextmanager
+from sklearn.pipeline import Pipeline
 
 mne.set_log_level('warning')
 
+CV_RANDOM_STATE = 42
 
-def evaluate_pipeline(pipeline, epochs, labels, n_splits=10, n_repeats=1):
+
+def evaluate_pipeline(pipeline, epochs, labels, n_splits=10, n_repeats=1, n_jobs=-1):
     print(f'Evaluating pipeline performance ({n_splits} splits, {n_repeats} repeats, {len(labels)} epochs)...')
-    results = cross_validate(pipeline, epochs, labels, cv=cross_validation(n_splits, n_repeats),
-                             return_train_score=True, n_jobs=-1)
+    prefix, tail = split_stateless(pipeline)
+    # computed once for all the folds instead of for every train and test fold
+    epochs = transform_steps(prefix, epochs)
+    with cv_data(tail, epochs) as (cv_pipeline, X):
+        results = cross_validate(cv_pipeline, X, labels, cv=cross_validation(n_splits, n_repeats),
+                                 return_train_score=True, n_jobs=n_jobs)
     print(
         f'\nTraining Accuracy: \n mean: {np.round(np.mean(results["train_score"]), 2)} \n std: {np.round(np.std(results["train_score"]), 3)}')
     print(
@@ -20,42 +32,147 @@ def evaluate_pipeline(pipeline, epochs, labels, n_splits=10, n_repeats=1):
     return np.round(np.mean(results["train_score"]), 2)
 
 
+def fit_and_evaluate_pipeline(pipeline_name, hyperparams, epochs, labels):
+    """
+    Create, fit and evaluate a pipeline of type in: ["spectral", "csp"].
+    Takes the pipeline module by name so it can run in a worker process.
+    """
+    pipeline = importlib.import_module(pipeline_name).create_pipeline(hyperparams)
+    pipeline.fit(epochs, labels)
+    score = evaluate_pipeline(pipeline, epochs, labels)
+    return pipeline, score
+
+
+def partial_fit_pipeline(pipeline, epochs, labels):
+    """
+    Update a pipeline created with incremental=True using only new epochs.
+    Steps with partial_fit are updated, other steps are stateless and just transform the new epochs. If a step can give
+    the features of every epoch it has seen (fitted_features), its output changed for the old epochs as well, so the
+    model is refit on those features instead of updated. If a step has no features yet (e.g. the CSP has only seen one
+    class), the model is left as is until a later update.
+    """
+    X, y = epochs, labels
+    refit_model = False
+    for _, step in pipeline.steps[:-1]:
+        if hasattr(step, "partial_fit"):
+            step.partial_fit(X, y)
+        if hasattr(step, "fitted_features"):
+            fitted = step.fitted_features()
+            if fitted is None:
+                return pipeline
+            X, y = fitted
+            refit_model = True
+        else:
+            X = step.transform(X)
+    model = pipeline.steps[-1][1]
+    if refit_model:
+        model.fit(X, y)
+    else:
+        model.partial_fit(X, y)
+    return pipeline
+
+
 def filter_hyperparams_for_pipeline(hyperparams, pipeline):
     return {key: hyperparams[key] for key in hyperparams if
             key.split("__")[0] in pipeline.get_params().keys()}
 
 
+def split_stateless(pipe):
+    """
+    Split a pipeline into (prefix, tail): the prefix is the list of leading steps marked stateless (their fit is a
+    no-op and they transform every epoch on its own), so their output for all the epochs can be computed once (see
+    transform_steps) and only the tail pipeline needs to be cross-validated. Estimators that aren't a Pipeline (e.g.
+    preprocessing.EpochRejector, which needs the raw epochs) have no prefix.
+    """
+    if not isinstance(pipe, Pipeline):
+        return [], pipe
+    n_stateless = 0
+    for _, step in pipe.steps[:-1]:
+        if not getattr(step, "stateless", False):
+            break
+        n_stateless += 1
+    return pipe.steps[:n_stateless], Pipeline(pipe.steps[n_stateless:])
+
+
+def transform_steps(steps, X):
+    for _, step in steps:
+        X = step.transform(X)
+    return X
+
+
 def show_pipeline_steps(pipeline):
     return " => ".join(list(pipeline.named_steps.keys()))
 
 
-def cross_validation(n_splits=10, n_repeats=1):
-    return RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats)
+def cross_validation(n_splits=10, n_repeats=1, random_state=CV_RANDOM_STATE):
+    # a fixed random state gives every search candidate the same folds, which makes them comparable and lets the
+    # preprocessing cache reuse filtered folds between candidates
+    return RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats, random_state=random_state)
 
 
-def bayesian_opt(epochs, labels, pipeline):
-    pipe = pipeline.create_pipeline()
-    opt = BayesSearchCV(
-        pipe,
-        pipeline.bayesian_search_space,
-        verbose=20,
-        n_iter=5,
-        cv=cross_validation(),
-        n_jobs=-1,
-    )
+@contextmanager
+def cv_data(pipe, epochs):
+    """
+    (pipeline, X) to cross-validate on: the epochs are put in shared memory once and the workers only get the epoch
+    indices of every fold (see shared_epochs). X that is already indices (filter bank mode) is used as is.
+    """
+    if np.ndim(epochs) != 3:
+        yield pipe, epochs
+        return
+    with share_epochs(epochs) as shared:
+        yield shared.pipeline(pipe), shared.epoch_indices()
+
 
-    opt.fit(epochs, labels)
+def filter_bank_search(pipe, epochs, pipeline, search_space):
+    """
+    Switch a pipeline to filter bank mode: the epochs are filtered once for every band on the pipeline's grid,
+    l_freq/h_freq in the search space are snapped to the grid, and the returned epoch indices should be passed to the
+    search instead of the epochs.
+    """
+    bank = create_filter_bank(epochs, 125, pipeline.filter_bank_l_freqs, pipeline.filter_bank_h_freqs)
+    pipe.set_params(preprocessing__filter_bank=bank)
+    search_space = {
+        **search_space,
+        "preprocessing__l_freq": Categorical(bank.l_freqs),
+        "preprocessing__h_freq": Categorical(bank.h_freqs),
+    }
+    return bank.epoch_indices(), search_space
 
-    print("Best parameter (CV score=%0.3f):" % opt.best_score_)
-    print(opt.best_params_)
-    return opt.best_params_, opt.best_score_, opt.cv_results_["std_test_score"][opt.best_index_]
+
+def bayesian_opt(epochs, labels, pipeline, use_filter_bank=False, early_stopping=False, n_iter=5, subject=None):
+    """
+    Bayesian search of the hyperparams of the pipeline (with its default model), see search.ModelSearch.
+    early_stopping: prune poor candidates after their first folds by successive halving, see search.run_searches.
+    subject: store the evaluated candidates in the trial database, and warm start from the subject's previous searches
+    """
+    from search import ModelSearch, data_key, run_searches  # search builds on this module
+    from trials import SearchTrials
+
+    pipe = pipeline.create_pipeline()
+    search_space = pipeline.bayesian_search_space
+    key = data_key(epochs, labels)
+    if use_filter_bank:
+        epochs, search_space = filter_bank_search(pipe, epochs, pipeline, search_space)
+    model = type(pipe.steps[-1][1]).__name__
+    store = None if subject is None else SearchTrials(subject, pipeline.name, model)
+    with cv_data(pipe, epochs) as (cv_pipe, X):
+        search = ModelSearch(model, cv_pipe, search_space, key, n_iter, store)
+        run_searches([search], X, labels, early_stopping=early_stopping)
+
+    best = search.best_trial()
+    if best is None:
+        raise ValueError(f'All {len(search.trials)} candidates of the {model} search failed or were pruned')
+    print("Best parameter (CV score=%0.3f):" % best["score"])
+    print(best["params"])
+    return best["params"], best["score"], best["std"]
 
 
 def grid_search_pipeline_hyperparams(epochs, labels, pipeline):
-    gs = GridSearchCV(pipeline.create_pipeline(), pipeline.grid_search_space, cv=cross_validation(), n_jobs=-1,
-                      verbose=10,
-                      error_score="raise")
-    gs.fit(epochs, labels)
+    with cv_data(pipeline.create_pipeline(), epochs) as (cv_pipe, X):
+        gs = GridSearchCV(cv_pipe, pipeline.grid_search_space, cv=cross_validation(), n_jobs=-1,
+                          verbose=10,
+                          error_score="raise")
+        gs.fit(X, labels)
     print("Best parameter (CV score=%0.3f):" % gs.best_score_)
     print(gs.best_params_)
     return gs.best_params_
@@ -85,5 +202,67 @@ def get_epochs(raws, trial_duration, calibration_duration, markers=[Marker.IDLE,
     return epochs, labels
 
 
+def recording_epochs_params(trial_duration, calibration_duration, markers):
+    return {
+        "trial_duration": trial_duration,
+        "calibration_duration": calibration_duration,
+        "markers": [int(marker) for marker in markers],
+    }
+
+
+def create_recording_epochs(rec_folder, trial_duration, calibration_duration,
+                            markers=[Marker.IDLE, Marker.LEFT, Marker.RIGHT]):
+    """
+    Epoch a recording's raw.fif and save the result to its epoch store
+    """
+    epochs, labels = get_epochs([load_recording(rec_folder)], trial_duration, calibration_duration, markers)
+    save_epochs(rec_folder, epochs.get_data(), labels,
+                recording_epochs_params(trial_duration, calibration_duration, markers))
+
+
+def get_recording_epochs(rec_folder, trial_duration, calibration_duration,
+                         markers=[Marker.IDLE, Marker.LEFT, Marker.RIGHT]):
+    """
+    Epochs (as a read-only memmap) and labels of a single recording. They are taken from the recording's epoch store,
+    which is created from raw.fif the first time (or when the epochs params change).
+    """
+    epochs_params = recording_epochs_params(trial_duration, calibration_duration, markers)
+    stored = load_epochs(rec_folder, epochs_params)
+    if stored is None:
+        create_recording_epochs(rec_folder, trial_duration, calibration_duration, markers)
+        stored = load_epochs(rec_folder, epochs_params)
+    return stored
+
+
+def get_recordings_epochs(rec_folders, trial_duration, calibration_duration,
+                          markers=[Marker.IDLE, Marker.LEFT, Marker.RIGHT], n_jobs=-1):
+    """
+    Epochs and labels of several recordings, in the order of rec_folders.
+    Recordings without an epoch store are read and epoched in parallel worker processes, then all the epochs are copied
+    into a single preallocated array.
+    """
+    epochs_params = recording_epochs_params(trial_duration, calibration_duration, markers)
+    missing = [rec_folder for rec_folder in rec_folders if load_epochs(rec_folder, epochs_params) is None]
+    if missing:
+        print(f'Epoching {len(missing)} recordings...')
+        Parallel(n_jobs=n_jobs)(
+            delayed(create_recording_epochs)(rec_folder, trial_duration, calibration_duration, markers)
+            for rec_folder in missing)
+
+    stored = [load_epochs(rec_folder, epochs_params) for rec_folder in rec_folders]
+    if len(stored) == 1:
+        return stored[0]
+
+    n_epochs = sum(len(rec_labels) for _, rec_labels in stored)
+    epochs = np.empty((n_epochs, *stored[0][0].shape[1:]), dtype=stored[0][0].dtype)
+    start = 0
+    for rec_epochs, _ in stored:
+        epochs[start:start + len(rec_epochs)] = rec_epochs
+        start += len(rec_epochs)
+    labels = np.concatenate([rec_labels for _, rec_labels in stored])
+    print(f'Found {len(labels)} epochs')
+    return epochs, labels
+
+
 if __name__ == "__main__":
     raw, params = load_recordings("Ori")
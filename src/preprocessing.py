@@ -1,8 +1,31 @@
+import hashlib
+import os
+from collections import OrderedDict
+from pathlib import Path
+
 import mne
 import numpy as np
 
 from board import EEG_CHAN_NAMES
-import scipy.stats
+from constants import CACHE_DIR
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+FILTER_CACHE_DIR = os.path.join(CACHE_DIR, "filter")
+FILTER_CACHE_MEMORY_BYTES = 512 * 2 ** 20
+FILTER_CACHE_DISK_BYTES = 4 * 2 ** 30
+FILTER_BANK_DIR = os.path.join(CACHE_DIR, "filter_bank")
+
+# epoch rejection thresholds (V)
+EPOCH_AMP_LOW = 1e-7
+EPOCH_AMP_HIGH = 200e-6
+EPOCH_FLAT = 1e-6  # peak to peak
+EPOCH_PTP_HIGH = None  # peak to peak, like mne's reject
+# the correlation checks are off by default, health_check flags channels outside of (0.05, 0.9)
+EPOCH_CORR_LOW = None
+EPOCH_CORR_HIGH = None
+EPOCH_MAX_BAD_CHANS = 3
+EPOCH_REJECT_REASONS = np.dtype([(reason, bool) for reason in
+                                  ["amp_low", "amp_high", "ptp_high", "flat", "corr_low", "corr_high"]])
 
 
 # LAPLACIAN = {
@@ -22,44 +45,309 @@ def laplacian(epochs):
     return filtered_epochs
 
 
+class FilterCache:
+    """
+    Content addressed cache for band-pass filtered epochs, keyed by (data fingerprint, filter params).
+    Recently used results are kept in memory. With max_disk_bytes, every result is also written to a shared folder on
+    disk so that joblib workers of the same search can reuse each other's results (loaded back as read-only memmaps).
+    Both stores are bounded and evict the least recently used entries.
+    """
+
+    def __init__(self, cache_dir=FILTER_CACHE_DIR, max_memory_bytes=FILTER_CACHE_MEMORY_BYTES, max_disk_bytes=0):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+
+    def filter_data(self, epochs, sfreq, l_freq, h_freq):
+        key = filter_cache_key(epochs, sfreq, l_freq, h_freq)
+        filtered = self._memory_get(key)
+        if filtered is None and self.max_disk_bytes > 0:
+            filtered = self._disk_get(key)
+        if filtered is None:
+            filtered = mne.filter.filter_data(epochs, sfreq, l_freq, h_freq, verbose=False)
+            self._disk_put(key, filtered)
+        filtered.flags.writeable = False
+        self._memory_put(key, filtered)
+        return filtered
+
+    def clear(self):
+        self._memory.clear()
+        self._memory_bytes = 0
+        if self.max_disk_bytes > 0:
+            for path in self._disk_entries():
+                remove_file(path)
+
+    def _memory_get(self, key):
+        if key not in self._memory:
+            return None
+        self._memory.move_to_end(key)
+        return self._memory[key]
+
+    def _memory_put(self, key, arr):
+        if key in self._memory or arr.nbytes > self.max_memory_bytes:
+            return
+        self._memory[key] = arr
+        self._memory_bytes += arr.nbytes
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+    def _disk_entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith(".npy")]
+
+    def _disk_get(self, key):
+        path = self._disk_path(key)
+        try:
+            arr = np.load(path, mmap_mode="r")
+            os.utime(path)  # mark as recently used for eviction
+        except (OSError, ValueError):
+            return None
+        return arr
+
+    def _disk_put(self, key, arr):
+        if self.max_disk_bytes <= 0:
+            return
+        Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        # write to a private file and rename it, so other workers never see a partially written entry
+        tmp_path = os.path.join(self.cache_dir, f'{key}.{os.getpid()}.tmp')
+        try:
+            with open(tmp_path, "wb") as file:
+                np.save(file, arr)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError:
+            remove_file(tmp_path)
+            return
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        for path in self._disk_entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_disk_bytes:
+                break
+            if remove_file(path):
+                total_bytes -= size
+
+
+def filter_cache_key(epochs, sfreq, l_freq, h_freq):
+    epochs = np.ascontiguousarray(epochs)
+    fingerprint = hashlib.blake2b(epochs, digest_size=16)
+    fingerprint.update(f'{epochs.shape}_{epochs.dtype}_{sfreq}_{l_freq}_{h_freq}'.encode())
+    return fingerprint.hexdigest()
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        # the file is gone already, or (on windows) still memory mapped by another worker
+        return False
+
+
+# memory only, so sessions and single evaluations don't write to the cache folder
+filter_cache = FilterCache()
+
+
+def use_disk_filter_cache(max_disk_bytes=FILTER_CACHE_DISK_BYTES):
+    """
+    Also store the filtered epochs of this process on disk, to share them with the other workers of a search.
+    It's per process, so it's called in the workers (see search).
+    """
+    filter_cache.max_disk_bytes = max_disk_bytes
+
+
+def cached_filter_data(epochs, sfreq, l_freq, h_freq):
+    """
+    Same as mne.filter.filter_data, but returns a read-only cached result if these epochs were already filtered with
+    the same params (by this process or by another worker)
+    """
+    return filter_cache.filter_data(epochs, sfreq, l_freq, h_freq)
+
+
+class FilterBank:
+    """
+    Band-passed copies of a set of epochs for every (l_freq, h_freq) pair on a fixed grid, stored as a memory mapped
+    array of shape (n_bands, n_epochs, n_channels, n_times).
+    A pipeline using the bank is fed epoch indices instead of epochs, so filtering a fold becomes a slice.
+    """
+
+    def __init__(self, path, l_freqs, h_freqs):
+        self.path = path
+        self.l_freqs = list(l_freqs)
+        self.h_freqs = list(h_freqs)
+        self.data = np.load(path, mmap_mode="r")
+
+    @property
+    def n_epochs(self):
+        return self.data.shape[1]
+
+    def epoch_indices(self):
+        """
+        The X to pass to a pipeline (or a search) that uses the bank, one row per epoch
+        """
+        return np.arange(self.n_epochs).reshape(-1, 1)
+
+    def band_index(self, l_freq, h_freq):
+        if l_freq not in self.l_freqs or h_freq not in self.h_freqs:
+            raise ValueError(f'Band ({l_freq}, {h_freq}) is not in the filter bank, l_freq must be one of '
+                             f'{self.l_freqs} and h_freq one of {self.h_freqs}')
+        return self.l_freqs.index(l_freq) * len(self.h_freqs) + self.h_freqs.index(h_freq)
+
+    def get(self, indices, l_freq, h_freq):
+        indices = np.asarray(indices, dtype=int).ravel()
+        return self.data[self.band_index(l_freq, h_freq)][indices]
+
+    # The bank is shared and read-only: sklearn's clone must not copy it, and workers reopen it from disk instead of
+    # receiving the whole array pickled
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        return {"path": self.path, "l_freqs": self.l_freqs, "h_freqs": self.h_freqs}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+def create_filter_bank(epochs, sfreq, l_freqs, h_freqs, bank_dir=FILTER_BANK_DIR):
+    """
+    Filter the epochs once for every (l_freq, h_freq) pair, the bank is stored on disk and reused if these epochs were
+    already filtered with the same grid
+    """
+    l_freqs, h_freqs = list(l_freqs), list(h_freqs)
+    path = os.path.join(bank_dir, f'{filter_cache_key(epochs, sfreq, l_freqs, h_freqs)}.npy')
+    if not os.path.exists(path):
+        print(f'Creating filter bank of {len(l_freqs) * len(h_freqs)} bands for {len(epochs)} epochs...')
+        Path(bank_dir).mkdir(parents=True, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        bank = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=epochs.dtype,
+                                         shape=(len(l_freqs) * len(h_freqs), *epochs.shape))
+        for l_idx, l_freq in enumerate(l_freqs):
+            for h_idx, h_freq in enumerate(h_freqs):
+                bank[l_idx * len(h_freqs) + h_idx] = mne.filter.filter_data(epochs, sfreq, l_freq, h_freq,
+                                                                            verbose=False)
+        bank.flush()
+        del bank
+        os.replace(tmp_path, path)
+    return FilterBank(path, l_freqs, h_freqs)
+
+
 def preprocess(raw):
     raw.load_data()
     raw.filter(2, 30)
     return raw
 
 
-def reject_epochs(epochs, labels):
-    bad_epochs = dict()
-    for epoch_idx, epoch in enumerate(epochs):
-        reasons = {
-            'bad_chans': [],
-            'reason': []
-        }
-        chan_index = list(range(len(epoch[:, 1])))
-        for chan in range(len(chan_index)):
-            curr_chan = epoch[chan, :]
-            if abs(curr_chan.min()) < 1 * 1e-7:
-                reasons['bad_chans'].append(chan)
-                reasons['reason'].append('amp low')
-            elif abs(curr_chan.max()) > 200 * 1e-6:
-                reasons['bad_chans'].append(chan)
-                reasons['reason'].append('amp high')
-            all_chan_except = chan_index.remove(chan)
-            # average_corr_chan = get_average_corr(curr_chan, epoch[all_chan_except, :])
-            # if abs(average_corr_chan) < 0.05:
-            #     reasons['bad_chans'].append(chan)
-            #     reasons['reason'].append('corr low')
-            # elif abs(average_corr_chan) > 0.9:
-            #     reasons['bad_chans'].append(chan)
-            #     reasons['reason'].append('corr high')
-
-        if len(reasons['bad_chans']) > 3:
-            bad_epochs[epoch_idx] = reasons
-    n_epochs_removed = len(bad_epochs.keys())
+def epoch_quality(epochs, amp_low=EPOCH_AMP_LOW, amp_high=EPOCH_AMP_HIGH, flat=EPOCH_FLAT, corr_low=EPOCH_CORR_LOW,
+                  corr_high=EPOCH_CORR_HIGH, ptp_high=EPOCH_PTP_HIGH):
+    """
+    Quality checks of every channel of every epoch, computed over the whole (n_epochs, n_channels, n_times) array.
+    Returns a structured array of shape (n_epochs, n_channels) with a boolean field for every reason in
+    EPOCH_REJECT_REASONS. A check is skipped if its threshold is None.
+    """
+    reasons = np.zeros(epochs.shape[:2], dtype=EPOCH_REJECT_REASONS)
+    if amp_low is not None:
+        reasons["amp_low"] = np.abs(epochs.min(axis=2)) < amp_low
+    if amp_high is not None:
+        reasons["amp_high"] = np.abs(epochs.max(axis=2)) > amp_high
+    if ptp_high is not None:
+        reasons["ptp_high"] = np.ptp(epochs, axis=2) > ptp_high
+    if flat is not None:
+        reasons["flat"] = np.ptp(epochs, axis=2) < flat
+    if (corr_low is not None or corr_high is not None) and epochs.shape[1] > 1:
+        avg_corr = np.abs(average_channel_corr(epochs))
+        if corr_low is not None:
+            reasons["corr_low"] = avg_corr < corr_low
+        if corr_high is not None:
+            reasons["corr_high"] = avg_corr > corr_high
+    return reasons
+
+
+def average_channel_corr(epochs):
+    """
+    Average correlation of every channel with the other channels of the same epoch, shape (n_epochs, n_channels).
+    Channels without any variance have 0 correlation.
+    """
+    centered = epochs - epochs.mean(axis=2, keepdims=True)
+    norms = np.linalg.norm(centered, axis=2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = (centered @ centered.transpose(0, 2, 1)) / (norms[:, :, None] * norms[:, None, :])
+    corr = np.nan_to_num(corr, nan=0.0, posinf=0.0, neginf=0.0)
+    n_channels = epochs.shape[1]
+    return (corr.sum(axis=2) - np.diagonal(corr, axis1=1, axis2=2)) / (n_channels - 1)
+
+
+def bad_chans(reasons):
+    """
+    Which channels of which epochs failed any check, from the result of epoch_quality
+    """
+    bad = np.zeros(reasons.shape, dtype=bool)
+    for reason in reasons.dtype.names:
+        bad |= reasons[reason]
+    return bad
+
+
+def good_epochs_mask(epochs, max_bad_chans=EPOCH_MAX_BAD_CHANS, **thresholds):
+    """
+    Boolean mask of the epochs with at most max_bad_chans bad channels, and the reasons of every channel
+    (see epoch_quality)
+    """
+    reasons = epoch_quality(epochs, **thresholds)
+    return bad_chans(reasons).sum(axis=1) <= max_bad_chans, reasons
+
+
+def reject_epochs(epochs, labels, max_bad_chans=EPOCH_MAX_BAD_CHANS, flat=None, **thresholds):
+    """
+    The epochs (and their labels) with at most max_bad_chans bad channels, the flat check is off unless flat is passed
+    """
+    good, reasons = good_epochs_mask(epochs, max_bad_chans, flat=flat, **thresholds)
+    n_epochs_removed = np.count_nonzero(~good)
     print(f"{n_epochs_removed} epochs rejected")
     if n_epochs_removed:
-        print(bad_epochs)
-    return np.delete(epochs, list(bad_epochs.keys()), axis=0), np.delete(labels, list(bad_epochs.keys()), axis=0)
+        print({reason: np.count_nonzero(reasons[reason][~good]) for reason in reasons.dtype.names})
+    return epochs[good], labels[good]
+
+
+class EpochRejector(BaseEstimator, ClassifierMixin):
+    """
+    Wraps a pipeline so that bad epochs are left out when it's fit, which happens inside every cross validation fold.
+    Epochs are never rejected at predict time, so every epoch gets a prediction.
+    e.g. evaluate_pipeline(EpochRejector(spectral.create_pipeline()), epochs, labels)
+    """
+
+    def __init__(self, estimator, max_bad_chans=EPOCH_MAX_BAD_CHANS, amp_low=EPOCH_AMP_LOW, amp_high=EPOCH_AMP_HIGH,
+                 flat=EPOCH_FLAT, corr_low=EPOCH_CORR_LOW, corr_high=EPOCH_CORR_HIGH):
+        self.estimator = estimator
+        self.max_bad_chans = max_bad_chans
+        self.amp_low = amp_low
+        self.amp_high = amp_high
+        self.flat = flat
+        self.corr_low = corr_low
+        self.corr_high = corr_high
+
+    def fit(self, epochs, labels):
+        good, _ = good_epochs_mask(epochs, self.max_bad_chans, amp_low=self.amp_low, amp_high=self.amp_high,
+                                   flat=self.flat, corr_low=self.corr_low, corr_high=self.corr_high)
+        self.estimator.fit(epochs[good], np.asarray(labels)[good])
+        self.classes_ = np.unique(labels)
+        return self
+
+    def predict(self, epochs):
+        return self.estimator.predict(epochs)
 
 
 def find_average_voltage(epochs):
@@ -68,14 +356,3 @@ def find_average_voltage(epochs):
         vol_per_chan[chan_inx + 1] = np.mean(epochs[:, chan_inx, :])
     return vol_per_chan
 
-
-def get_average_corr(chan, all_chans):
-    total_corr = 0
-    for other_chan in all_chans:
-        if len(chan) != len(other_chan) or len(chan) < 2 or len(other_chan) < 2:
-            continue
-        corr, _ = scipy.stats.pearsonr(chan, other_chan)
-        if not np.isnan(corr):
-            total_corr += corr
-    avg_corr = total_corr / len(all_chans)
-    return avg_corr
@@ -1,15 +1,27 @@
 import numpy as np
 from Marker import Marker
-from board import Board
+from board import create_board
 from psychopy import sound
 
-from pipeline import get_epochs, evaluate_pipeline
-from data_utils import load_rec_params, save_raw, load_hyperparams
+from pipeline import evaluate_pipeline, fit_and_evaluate_pipeline, partial_fit_pipeline, get_recording_epochs
+from data_utils import load_rec_params, start_session_folder, load_hyperparams
+from session_writer import SessionWriter
 import spectral
 import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from health_daemon import health_publishing
+from latency import TrialSpans
+from inference import create_runtime
+from preprocessing import good_epochs_mask
+import time
 
 BG_COLOR = "black"
 STIM_COLOR = "white"
+# seconds after the end of a trial to wait for the samples of its epoch
+FETCH_TIMEOUT = 3
+# the checks of pipeline.get_epochs (mne's reject and flat, in V) on the epochs used for retraining
+ONLINE_EPOCH_CHECKS = dict(max_bad_chans=0, amp_low=None, amp_high=None, ptp_high=100e-6, flat=1e-6)
 
 visual = None
 core = None
@@ -36,75 +48,141 @@ def run_session(params, retrain_pipeline=spectral, predict_pipeline=None, epochs
     loop_through_messages(win, [msg1])
 
     if retrain_pipeline:
-        hyperparams = load_hyperparams(params["subject"], retrain_pipeline)
-        predict_pipeline = retrain_pipeline.create_pipeline(hyperparams)
+        hyperparams = load_hyperparams(params["subject"], retrain_pipeline.name)
+        predict_pipeline = retrain_pipeline.create_pipeline(hyperparams,
+                                                            incremental=params.get("incremental_retrain", False))
         predict_pipeline.fit(epochs, labels)
         best_score = evaluate_pipeline(predict_pipeline, epochs, labels)
-
-    # Start recording
-    with Board(use_synthetic=params["use_synthetic_board"]) as board:
-        for i, marker in enumerate(trial_markers):
-            # "get ready" period
-            show_stim_for_duration(win, progress_text(win, i + 1, len(trial_markers), marker),
-                                   progress_sound(marker), params["get_ready_duration"])
-            # calibration period
-            core.wait(params["calibration_duration"])
-
-            # motor imagery period
-            board.insert_marker(marker)
-            show_stim_with_beeps(win, marker_stim(win, marker), params["trial_duration"])
-
-            if predict_pipeline:
-                # We need to wait a short time between the end of the trial and trying to get it's data to make sure
-                # that we have recorded (trial_duration * sfreq) samples after the latest marker (otherwise the epoch
-                # will be too short)
-                core.wait(0.5)
-
-                # get latest epoch and make prediction
-                raw = board.get_data()
-                new_epochs, new_labels = get_epochs([raw], params["trial_duration"], params["calibration_duration"],
-                                                    on_missing='ignore')
-                new_epochs = new_epochs.get_data()
-                prediction = predict_pipeline.predict(new_epochs)[-1]
-
-                # display prediction result
-                show_stim_for_duration(win, classification_result_txt(win, marker, prediction),
-                                       classification_result_sound(marker, prediction),
-                                       params["display_online_result_duration"])
-
-            if retrain_pipeline and i % params["retrain_num"] == 0 and i != 0:
-                text_stim(win, "Retraining model, please wait...").draw()
-                win.flip()
-
-                # train new pipeline
-                total_epochs = np.concatenate((epochs, new_epochs), axis=0)
-                total_labels = np.concatenate((labels, new_labels), axis=0)
-                new_pipeline = retrain_pipeline.create_pipeline(hyperparams)
-                new_pipeline.fit(total_epochs, total_labels)
-
-                # evaluate new pipeline
-                score = evaluate_pipeline(new_pipeline, total_epochs, total_labels)
-                msg = f'Finished retraining \nold model score: {best_score} \nnew model score: {score}'
-                win.flip()
-                predict_pipeline = new_pipeline
-
-                if score > best_score:
-                    best_score = score
-                    msg += "\nNice! the model has improved!"
-                else:
-                    msg += "\nNo improvement, Focus man.."
-                msg += "\n Press any key to continue, ESC to exit"
-
-                text_stim(win, msg).draw()
-                win.flip()
-                keys_pressed = event.waitKeys()
-                if 'escape' in keys_pressed:
-                    core.quit()
-
-        core.wait(0.5)
-        win.close()
-        raw = board.get_data()
-    save_raw(raw, params)
+    # filters, projections and weights of the pipeline precomputed for online prediction
+    runtime = create_runtime(predict_pipeline) if predict_pipeline else None
+    if runtime and epochs is not None:
+        runtime.predict(epochs[0])  # compiles the filter for the epoch length before the first trial
+
+    # epochs recorded during this session, used for retraining
+    new_epochs, new_labels = [], []
+    retrain_executor = ProcessPoolExecutor(max_workers=1)
+    retrain_future = None
+    n_epochs_retrained = 0
+    spans = TrialSpans()
+
+    # Start recording, samples are written to the session folder while recording
+    folder_path = start_session_folder(params)
+    try:
+        # electrode health is published during the session if a "health_stream" is configured
+        with create_board(params) as board, health_publishing(board, params) as health_publisher:
+            session_writer = SessionWriter(board, folder_path).start()
+            for i, marker in enumerate(trial_markers):
+                # stop the session if its samples can't be written anymore, or its health can't be published
+                session_writer.check()
+                if health_publisher:
+                    health_publisher.check()
+                # "get ready" period
+                show_stim_for_duration(win, progress_text(win, i + 1, len(trial_markers), marker),
+                                       progress_sound(marker), params["get_ready_duration"])
+                # calibration period
+                core.wait(params["calibration_duration"])
+
+                # motor imagery period
+                board.insert_marker(marker)
+                show_stim_with_beeps(win, marker_stim(win, marker), params["trial_duration"])
+                trial_end = time.perf_counter()
+
+                if predict_pipeline:
+                    # We need to wait a short time between the end of the trial and trying to get it's data to make
+                    # sure that we have recorded (trial_duration * sfreq) samples after the latest marker (otherwise the
+                    # epoch will be too short)
+                    core.wait(0.5)
+
+                    # get latest epoch and make prediction
+                    with spans.span(i, "fetch"):
+                        latest_epoch, latest_label = fetch_latest_epoch(board, params, trial_end + FETCH_TIMEOUT)
+                    if latest_epoch is None:
+                        print(f'Trial {i + 1}: the epoch was not complete {FETCH_TIMEOUT} seconds after the end of the '
+                              f'trial, skipping its prediction')
+                    else:
+                        latest_epochs = latest_epoch[np.newaxis]
+                        good, _ = good_epochs_mask(latest_epochs, **ONLINE_EPOCH_CHECKS)
+                        if good[0]:
+                            new_epochs.append(latest_epochs)
+                            new_labels.append(np.array([latest_label]))
+                        else:
+                            print(f'Trial {i + 1}: the epoch is bad, leaving it out of the retraining data')
+                        with spans.span(i, "features"):
+                            features = runtime.features(latest_epoch)
+                        with spans.span(i, "predict"):
+                            prediction = runtime.predict_features(features)
+
+                        # display prediction result
+                        with spans.span(i, "render"):
+                            show_stim(win, classification_result_txt(win, marker, prediction),
+                                      classification_result_sound(marker, prediction))
+                        # from the end of the trial to the feedback being on screen
+                        spans.add(i, "feedback", trial_end, time.perf_counter())
+                        core.wait(params["display_online_result_duration"])
+                        win.flip()
+
+                retrain_start = time.perf_counter()
+
+                # swap in the retrained pipeline as soon as the background worker is done with it
+                if retrain_future is not None and retrain_future.done():
+                    try:
+                        new_pipeline, score = retrain_future.result()
+                    except Exception as e:
+                        print(f'Retraining failed: {e!r}, keeping the current model')
+                        if isinstance(e, BrokenProcessPool):
+                            # the worker process died, the pool can't be used anymore
+                            retrain_executor.shutdown(wait=False)
+                            retrain_executor = ProcessPoolExecutor(max_workers=1)
+                    else:
+                        print(f'Finished retraining \nold model score: {best_score} \nnew model score: {score}')
+                        if score > best_score:
+                            best_score = score
+                            predict_pipeline = new_pipeline
+                            runtime = create_runtime(predict_pipeline)
+                            print("Nice! the model has improved!")
+                    retrain_future = None
+
+                if retrain_pipeline and i % params["retrain_num"] == 0 and i != 0:
+                    if params.get("incremental_retrain", False):
+                        # update the pipeline with the epochs recorded since the last retraining only, this takes the
+                        # same time at any point in the session so it's done right away (without evaluating the new
+                        # model)
+                        if len(new_epochs) > n_epochs_retrained:
+                            partial_fit_pipeline(predict_pipeline, np.concatenate(new_epochs[n_epochs_retrained:]),
+                                                 np.concatenate(new_labels[n_epochs_retrained:]))
+                            n_epochs_retrained = len(new_epochs)
+                            runtime = create_runtime(predict_pipeline)
+                    elif retrain_future is None:
+                        # train and evaluate a new pipeline in the background, the session keeps running meanwhile
+                        total_epochs = np.concatenate([epochs] + new_epochs, axis=0)
+                        total_labels = np.concatenate([labels] + new_labels, axis=0)
+                        retrain_future = retrain_executor.submit(fit_and_evaluate_pipeline, retrain_pipeline.name,
+                                                                 hyperparams, total_epochs, total_labels)
+                    else:
+                        print("Previous retraining is still running, skipping this one")
+                spans.add(i, "retrain", retrain_start, time.perf_counter())
+
+            core.wait(0.5)
+            win.close()
+            with spans.span(len(trial_markers), "finalize"):
+                rec_folder = session_writer.finalize()
+    finally:
+        # pending retrainings are cancelled, and the session doesn't wait for one that is running
+        retrain_executor.shutdown(wait=False, cancel_futures=True)
+    spans.save(folder_path)
+    # create the recording's epoch store now, so later workflows don't have to epoch the raw again
+    get_recording_epochs(rec_folder, params["trial_duration"], params["calibration_duration"])
+
+
+def fetch_latest_epoch(board, params, deadline):
+    """
+    The latest epoch and its label, (None, None) if the epoch is still incomplete at deadline (a time.perf_counter time)
+    """
+    while True:
+        latest_epoch, latest_label = board.get_latest_epoch(-params["calibration_duration"], params["trial_duration"])
+        if latest_epoch is not None or time.perf_counter() > deadline:
+            return latest_epoch, latest_label
+        core.wait(0.05)
 
 
 def loop_through_messages(win, messages):
@@ -124,6 +202,12 @@ def marker_stim(win, marker):
 
 
 def show_stim_for_duration(win, vis_stim, aud_stim, duration):
+    show_stim(win, vis_stim, aud_stim)
+    core.wait(duration)
+    win.flip()  # flip back to the (now empty) back buffer
+
+
+def show_stim(win, vis_stim, aud_stim):
     # Adding this code here is an easy way to make sure we check for an escape event before showing every stimulus
     if 'escape' in event.getKeys():
         core.quit()
@@ -131,8 +215,6 @@ def show_stim_for_duration(win, vis_stim, aud_stim, duration):
     vis_stim.draw()  # draw stim on back buffer
     aud_stim.play()
     win.flip()  # flip the front and back buffers and then clear the back buffer
-    core.wait(duration)
-    win.flip()  # flip back to the (now empty) back buffer
 
 
 def text_stim(win, text):
@@ -0,0 +1,317 @@
+"""
+Search of the best model family (and its hyperparams) of a pipeline for a subject.
+The Bayesian searches of all the families run concurrently: every round each unfinished search asks for its next
+candidate, and all the candidates are evaluated by one pool of n_jobs workers. Every evaluated candidate is stored
+in the trial database (see trials.py), so an interrupted search resumes where it stopped and a search on a new session
+of the subject is warm started, and the best result of every family so far is written to <subject>_pipeline_results
+after every round.
+With early_stopping, candidates are evaluated by successive halving: their first folds are scored first, and only the
+candidates in the top 1 / HALVING_ETA of the candidates scored on the same folds so far are promoted to more folds.
+"""
+import hashlib
+import json
+import os
+import time
+from contextlib import ExitStack, nullcontext
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from skopt import Optimizer
+from skopt.utils import dimensions_aslist, point_asdict
+
+from pipeline import cross_validation, filter_bank_search, split_stateless, transform_steps
+from preprocessing import use_disk_filter_cache
+from shared_epochs import share_epochs
+from trials import SearchTrials
+
+SEARCH_N_ITER = 100
+HALVING_RUNGS = [2, 5]  # numbers of folds after which a candidate may be pruned, the last rung is all the folds
+HALVING_ETA = 3
+RETUNE_N_ITER = 20  # iterations of a search warm started from a subject's previous searches, e.g. after a new session
+WARM_START_TOP = 5  # best candidates of the subject's previous searches evaluated first
+
+
+class ModelSearch:
+    """
+    Bayesian search of one model family (the same skopt Optimizer BayesSearchCV uses). With a trials.SearchTrials,
+    every evaluated candidate is stored in the trial database: the search resumes from the candidates already
+    evaluated on the same data, and its surrogate model is warm started with the candidates of previous searches
+    """
+
+    def __init__(self, name, pipe, search_space, data_key, n_iter=SEARCH_N_ITER, store=None):
+        self.name = name
+        self.pipe = pipe
+        self.search_space = search_space
+        self.data_key = data_key
+        self.n_iter = n_iter
+        self.store = store
+        self.optimizer = Optimizer(dimensions_aslist(search_space))
+        self.trials = []
+        self.evaluated = {}  # {params_key: trial} of the candidates evaluated on this data
+        self.warm_queue = []  # best params of previous searches, evaluated first
+        self.rung_scores = {}  # {n_folds: [mean score on the first n_folds of every candidate that got there]}
+        self._resume()
+
+    @property
+    def done(self):
+        return len(self.trials) >= self.n_iter
+
+    def _resume(self):
+        if self.store is None:
+            return
+        # candidates outside of the (possibly changed) search space are ignored
+        trials = [trial for trial in self.store.evaluated(self.data_key) if self._in_space(trial["params"])]
+        previous = [trial for trial in self.store.previous(self.data_key) if self._in_space(trial["params"])]
+        if not trials and not previous:
+            return
+        self.optimizer.tell([self._point(trial["params"]) for trial in previous + trials],
+                            [-trial["score"] for trial in previous + trials])
+        self.trials = trials
+        for trial in trials:
+            self.evaluated[params_key(trial["params"])] = trial
+            for rung in HALVING_RUNGS:
+                if rung <= len(trial["fold_scores"]) and not trial["failed"]:
+                    self.rung_scores.setdefault(rung, []).append(float(np.mean(trial["fold_scores"][:rung])))
+        # the best candidates of the subject's previous searches are likely good on new sessions too
+        for trial in sorted(previous, key=lambda trial: trial["score"], reverse=True):
+            key = params_key(trial["params"])
+            if len(self.warm_queue) == WARM_START_TOP:
+                break
+            if trial["subject"] == self.store.subject and not trial["pruned"] and not trial["failed"] and \
+                    key not in self.evaluated and trial["params"] not in self.warm_queue:
+                self.warm_queue.append(trial["params"])
+        print(f'{self.name}: resumed {len(trials)} trials, warm started with {len(previous)} previous trials')
+
+    def _point(self, params):
+        return [params[key] for key in sorted(self.search_space)]
+
+    def _in_space(self, params):
+        return set(params) == set(self.search_space) and self._point(params) in self.optimizer.space
+
+    def ask(self, n_points=1):
+        """
+        The next candidates to evaluate. Candidates already evaluated on this data aren't evaluated again, their
+        stored trial counts as the trial instead
+        """
+        n_points = min(n_points, self.n_iter - len(self.trials))
+        candidates = self.warm_queue[:n_points]
+        del self.warm_queue[:n_points]
+        if len(candidates) < n_points:
+            # plain python values, some estimators reject numpy scalars (e.g. mne's CSP n_components)
+            candidates += [{key: json_value(value) for key, value in point_asdict(self.search_space, point).items()}
+                           for point in self.optimizer.ask(n_points - len(candidates))]
+        new = []
+        for params in candidates:
+            trial = self.evaluated.get(params_key(params))
+            if trial is None:
+                new.append(params)
+            else:
+                self.optimizer.tell(self._point(params), -trial["score"])
+                self.trials.append(trial)
+        return new
+
+    def promote(self, rung, score):
+        """
+        Whether a candidate scoring score (mean) on the first rung folds is evaluated on more folds: the first
+        HALVING_ETA candidates are, after that only the ones in the top 1 / HALVING_ETA of the scores at that rung
+        """
+        if np.isnan(score):
+            return False
+        previous = self.rung_scores.setdefault(rung, [])
+        promoted = len(previous) < HALVING_ETA or score >= np.quantile(previous, 1 - 1 / HALVING_ETA)
+        previous.append(float(score))
+        return bool(promoted)
+
+    def tell(self, params, fold_scores, pruned=False, fit_time=0.0):
+        """
+        fold_scores: the scores of the folds evaluated, only the first ones if the candidate was pruned.
+        fit_time: seconds spent evaluating the candidate, summed over the workers
+        """
+        fold_scores = np.asarray(fold_scores, dtype=float)
+        failed = bool(np.isnan(fold_scores).any())
+        # a failed candidate is told the worst possible accuracy, so the optimizer moves away from it. A pruned one is
+        # told its mean on the folds it was evaluated on
+        score = 0.0 if failed else float(fold_scores.mean())
+        trial = {"params": params, "score": score, "std": 0.0 if failed else float(fold_scores.std()),
+                 "failed": failed, "pruned": pruned, "fold_scores": fold_scores.tolist(), "fit_time": fit_time,
+                 "data": self.data_key}
+        self.optimizer.tell(self._point(params), -score)
+        self.trials.append(trial)
+        self.evaluated[params_key(params)] = trial
+        if self.store is not None:
+            self.store.add(trial)
+
+    def best_trial(self):
+        """
+        The best candidate evaluated on all the folds, pruned candidates' scores on fewer folds aren't comparable.
+        None if no candidate was, or they all failed.
+        """
+        trials = [trial for trial in self.trials if not trial.get("pruned", False) and not trial.get("failed", False)]
+        if not trials:
+            return None
+        return max(trials, key=lambda trial: trial["score"])
+
+
+def json_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def data_key(epochs, labels):
+    epochs = np.ascontiguousarray(epochs)
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(str(epochs.shape).encode())
+    digest.update(epochs.data)
+    digest.update(np.ascontiguousarray(labels).data)
+    return digest.hexdigest()
+
+
+def transform_prefix(prefix, X):
+    """
+    (output, seconds), the output is None if the prefix failed
+    """
+    use_disk_filter_cache()
+    start = time.perf_counter()
+    try:
+        return transform_steps(prefix, X), time.perf_counter() - start
+    except Exception as e:
+        print(f'Candidate failed: {e!r}')
+        return None, time.perf_counter() - start
+
+
+def fit_and_score(pipe, X, labels, train, test):
+    """
+    (score, seconds), the score is nan if the pipeline failed
+    """
+    use_disk_filter_cache()
+    start = time.perf_counter()
+    try:
+        pipe.fit(X[train], labels[train])
+        return pipe.score(X[test], labels[test]), time.perf_counter() - start
+    except Exception as e:
+        print(f'Candidate failed: {e!r}')
+        return np.nan, time.perf_counter() - start
+
+
+def run_searches(searches, X, labels, n_jobs=-1, n_points=1, on_round=None, early_stopping=False):
+    """
+    Run the searches concurrently until they are all done, the candidates of all the searches are evaluated by the
+    same pool of workers.
+    The stateless prefix of every candidate (see pipeline.split_stateless) is computed once for all the epochs, and only
+    the tail of the pipeline is cross-validated on its output.
+    early_stopping: evaluate the candidates by successive halving over the folds (see HALVING_RUNGS), the candidates
+    pruned before the last fold are told their partial score but are never the best trial
+    """
+    labels = np.asarray(labels)
+    folds = list(cross_validation().split(X, labels))
+    rungs = [rung for rung in HALVING_RUNGS if rung < len(folds)] if early_stopping else []
+    rungs.append(len(folds))
+    with Parallel(n_jobs=n_jobs) as parallel:
+        while not all(search.done for search in searches):
+            candidates = [(search, params) for search in searches if not search.done for params in
+                          search.ask(n_points)]
+            split_pipes = [split_stateless(clone(search.pipe).set_params(**params)) for search, params in candidates]
+            prefix_outputs = iter(parallel(delayed(transform_prefix)(prefix, X) for prefix, _ in split_pipes if prefix))
+            outputs, fit_times = [], []
+            for prefix, _ in split_pipes:
+                output, seconds = next(prefix_outputs) if prefix else (X, 0.0)
+                outputs.append(output)
+                fit_times.append(seconds)
+            fold_scores = [[np.nan] * len(folds) if output is None else [] for output in outputs]
+            with ExitStack() as stack:
+                cv_inputs = {}
+                for i, ((_, tail), output) in enumerate(zip(split_pipes, outputs)):
+                    if output is None:
+                        continue
+                    # prefix outputs that are still epochs are shared with the workers like the input epochs
+                    if np.ndim(output) == 3:
+                        shared = stack.enter_context(share_epochs(output))
+                        tail, output = shared.pipeline(tail), shared.epoch_indices()
+                    cv_inputs[i] = tail, output
+                # the folds of every rung are evaluated for all the candidates still in the running at once
+                first_fold = 0
+                for rung in rungs:
+                    tasks = [(i, delayed(fit_and_score)(tail, output, labels, train, test))
+                             for i, (tail, output) in cv_inputs.items() for train, test in folds[first_fold:rung]]
+                    for (i, _), (score, seconds) in zip(tasks, parallel(task for _, task in tasks)):
+                        fold_scores[i].append(score)
+                        fit_times[i] += seconds
+                    first_fold = rung
+                    if rung < len(folds):
+                        cv_inputs = {i: cv_input for i, cv_input in cv_inputs.items()
+                                     if candidates[i][0].promote(rung, np.mean(fold_scores[i]))}
+            for (search, params), scores, fit_time in zip(candidates, fold_scores, fit_times):
+                pruned = len(scores) < len(folds)
+                search.tell(params, scores, pruned, fit_time)
+                best = search.best_trial()
+                print(f'{search.name}: trial {len(search.trials)}/{search.n_iter}, score '
+                      f'{search.trials[-1]["score"]:.3f}{f" (pruned after {len(scores)} folds)" if pruned else ""}, '
+                      f'best {best["score"] if best else np.nan:.3f}')
+            if on_round is not None:
+                on_round()
+
+
+def search_results(searches, pipeline_name):
+    results = []
+    for search in searches:
+        best = search.best_trial()
+        if best is None:
+            continue
+        results.append({
+            **best["params"],
+            "pipeline": pipeline_name,
+            "model": search.name,
+            "accuracy": best["score"],
+            "std": best["std"],
+            "n_trials": len(search.trials),
+            "n_pruned": sum(trial.get("pruned", False) for trial in search.trials),
+        })
+    return results
+
+
+def find_best_models(subject, pipeline, models, epochs, labels, use_filter_bank=False, n_iter=SEARCH_N_ITER,
+                     n_jobs=-1, n_points=1, early_stopping=False):
+    """
+    Search the hyperparams of the pipeline with every model in models ([{"model": class, "search_space": {...}}]).
+    n_jobs: workers shared by all the searches, n_points: candidates every search evaluates per round,
+    early_stopping: prune poor candidates after their first folds (see run_searches).
+    Returns the best result of every model, also saved to ../<subject>_pipeline_results/<pipeline>_results.csv
+    """
+    results_dir = f'../{subject}_pipeline_results'
+    Path(results_dir).mkdir(exist_ok=True)
+    results_path = os.path.join(results_dir, f'{pipeline.name}_results.csv')
+    key = data_key(epochs, labels)
+
+    # the epochs are put in shared memory once for all the searches, the workers only get fold indices
+    with nullcontext() if use_filter_bank else share_epochs(epochs) as shared:
+        searches = []
+        for model in models:
+            pipe = pipeline.create_pipeline(model=model["model"])
+            search_space = {
+                **pipeline.bayesian_search_space,
+                **model["search_space"],
+            }
+            if use_filter_bank:
+                X, search_space = filter_bank_search(pipe, epochs, pipeline, search_space)
+            else:
+                pipe, X = shared.pipeline(pipe), shared.epoch_indices()
+            name = model["model"].__name__
+            store = SearchTrials(subject, pipeline.name, name)
+            searches.append(ModelSearch(name, pipe, search_space, key, n_iter, store))
+
+        def save_results():
+            pd.DataFrame(search_results(searches, pipeline.name)).to_csv(results_path)
+
+        run_searches(searches, X, labels, n_jobs, n_points, on_round=save_results, early_stopping=early_stopping)
+        save_results()
+
+    results = search_results(searches, pipeline.name)
+    for result in results:
+        print(f'{result["model"]}: best CV score {result["accuracy"]:.3f}')
+    return results
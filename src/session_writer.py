@@ -0,0 +1,119 @@
+"""
+Writing a session to its folder while it's recorded: new samples are appended to a chunk file every few seconds by a
+background thread, and the chunk file is converted to raw.fif when the session ends.
+If a session crashes, its samples up to the last flush are in the chunk file and can still be converted with
+finalize_session.
+"""
+import json
+import os
+import threading
+
+import mne
+import numpy as np
+
+import catalog
+
+CHUNKS_FILE = "samples.bin"
+STREAM_FILE = "stream.json"
+FLUSH_SECONDS = 5
+DTYPE = np.float64
+
+
+class SessionWriter:
+    """
+    Thread appending the samples of a board.Board to the chunk file of a session folder every flush_seconds.
+    The board's ring buffer is read (and BrainFlow's buffer is drained), so memory use doesn't grow with the length of
+    the session.
+    """
+
+    def __init__(self, board, folder_path, flush_seconds=FLUSH_SECONDS):
+        if flush_seconds * board.sfreq * 2 > board.ring_buffer.capacity:
+            raise ValueError("The board's ring buffer must hold at least two flush intervals of samples")
+        self.board = board
+        self.folder_path = folder_path
+        self.flush_seconds = flush_seconds
+        self.n_written = 0
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        info = board.info
+        json_dump_stream(folder_path, {"ch_names": info.ch_names, "ch_types": info.get_channel_types(),
+                                       "sfreq": info["sfreq"], "dtype": np.dtype(DTYPE).str})
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def run(self):
+        try:
+            with open(os.path.join(self.folder_path, CHUNKS_FILE), "ab") as file:
+                while not self._stop.wait(self.flush_seconds):
+                    self.flush(file)
+                self.flush(file)
+        except Exception as e:
+            # kept for check and finalize, an exception in the thread would otherwise only be printed
+            self.error = e
+
+    def flush(self, file):
+        with self.board.lock:
+            self.board.update()
+            new = self.board.ring_buffer.get(self.n_written, self.board.ring_buffer.n_samples)
+            if new is None:
+                raise RuntimeError("Samples were overwritten in the ring buffer before being written")
+            new = new.T.astype(DTYPE)  # copy, stored sample by sample so chunks can be appended
+        file.write(new.tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+        self.n_written += len(new)
+
+    def check(self):
+        """
+        Raise the error that stopped the thread, if any
+        """
+        if self.error is not None:
+            raise RuntimeError(f'Writing the session to {self.folder_path} failed') from self.error
+
+    def finalize(self):
+        """
+        Stop the thread after writing the remaining samples and convert the chunk file to raw.fif.
+        If writing failed the chunk file is left as is, with the samples up to the last flush.
+        """
+        self._stop.set()
+        self._thread.join()
+        self.check()
+        return finalize_session(self.folder_path)
+
+
+def json_dump_stream(folder_path, stream):
+    with open(os.path.join(folder_path, STREAM_FILE), "w") as file:
+        json.dump(stream, file)
+
+
+def load_chunks(folder_path):
+    """
+    The samples written to a session's chunk file so far, as an mne raw
+    """
+    with open(os.path.join(folder_path, STREAM_FILE)) as file:
+        stream = json.load(file)
+    n_channels = len(stream["ch_names"])
+    samples = np.fromfile(os.path.join(folder_path, CHUNKS_FILE), dtype=stream["dtype"])
+    # a crash during a write may leave a partial sample at the end
+    samples = samples[:len(samples) // n_channels * n_channels].reshape(-1, n_channels)
+    info = mne.create_info(stream["ch_names"], stream["sfreq"], stream["ch_types"])
+    info.set_montage("standard_1020")
+    return mne.io.RawArray(samples.T, info, verbose=False)
+
+
+def finalize_session(folder_path):
+    """
+    Convert a session's chunk file to raw.fif, add the recording to the catalog and remove the chunk files.
+    Returns the recording folder name.
+    """
+    load_chunks(folder_path).save(os.path.join(folder_path, "raw.fif"), overwrite=True)
+    with open(os.path.join(folder_path, "params.json")) as file:
+        params = json.load(file)
+    folder = os.path.basename(folder_path)
+    catalog.add_recording(folder, params)
+    os.remove(os.path.join(folder_path, CHUNKS_FILE))
+    os.remove(os.path.join(folder_path, STREAM_FILE))
+    return folder
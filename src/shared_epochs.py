@@ -0,0 +1,99 @@
+"""
+Data plane for cross-validation and searches: the epochs are written once to shared memory (a memory mapped file in
+/dev/shm when available) and the workers are only sent epoch indices for every fold. A pipeline gets an EpochLoader
+first step that maps the indices back to the epochs, so every worker reads the same single copy of the data.
+"""
+import os
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from sklearn.pipeline import Pipeline
+
+from constants import CACHE_DIR
+
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else os.path.join(CACHE_DIR, "shared")
+LOADER_STEP = "epochs"
+ESTIMATOR_STEP = "estimator"
+
+
+class SharedEpochs:
+    """
+    Read-only epochs in a memory mapped .npy file, opened (not copied) by every process using them
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = np.load(path, mmap_mode="r")
+
+    def epoch_indices(self):
+        """
+        The X to pass to a pipeline (or a search) that uses the shared epochs, one row per epoch
+        """
+        return np.arange(len(self.data)).reshape(-1, 1)
+
+    def get(self, indices):
+        return self.data[np.asarray(indices, dtype=int).ravel()]
+
+    def pipeline(self, pipe):
+        """
+        pipe with an EpochLoader first step, so it takes epoch_indices() instead of the epochs. An estimator that isn't
+        a Pipeline (e.g. preprocessing.EpochRejector) becomes the step after the loader.
+        """
+        steps = pipe.steps if isinstance(pipe, Pipeline) else [(ESTIMATOR_STEP, pipe)]
+        return Pipeline([(LOADER_STEP, EpochLoader(self)), *steps])
+
+    # Like preprocessing.FilterBank: clone must not copy the data, and workers reopen the file instead of receiving
+    # the array pickled
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class EpochLoader:
+    stateless = True
+
+    def __init__(self, shared=None):
+        self.shared = shared
+
+    def set_params(self, shared=None):
+        if shared is not None:
+            self.shared = shared
+
+    def fit(self, indices, labels):
+        return self
+
+    def transform(self, indices):
+        return self.shared.get(indices)
+
+
+@contextmanager
+def share_epochs(epochs, shared_dir=SHARED_DIR):
+    """
+    Write the epochs to shared memory for the duration of the block, yields the SharedEpochs
+    """
+    Path(shared_dir).mkdir(parents=True, exist_ok=True)
+    path = os.path.join(shared_dir, f'epochs-{os.getpid()}-{uuid.uuid4().hex}.npy')
+    try:
+        np.save(path, np.asarray(epochs))
+        yield SharedEpochs(path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def strip_loader(pipe):
+    """
+    The pipeline without its EpochLoader step (if it has one), e.g. to save a pipeline fitted in a search
+    """
+    if pipe.steps[0][0] == LOADER_STEP:
+        if len(pipe.steps) == 2 and pipe.steps[1][0] == ESTIMATOR_STEP:
+            return pipe.steps[1][1]
+        return Pipeline(pipe.steps[1:])
+    return pipe
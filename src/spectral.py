@@ -1,8 +1,8 @@
 from sklearn.pipeline import Pipeline
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
-from preprocessing import laplacian
-import mne
-from mne_features.univariate import compute_pow_freq_bands
+from preprocessing import laplacian, cached_filter_data
+from features import pow_freq_bands
+from incremental import IncrementalLDA
 import mne_features.univariate as mnf
 import numpy as np
 from pipeline import show_pipeline_steps, filter_hyperparams_for_pipeline
@@ -22,6 +22,8 @@ all_freq_bands = {
 
 
 class Preprocessor:
+    stateless = True
+
     def __init__(self):
         self.l_freq = 7
         self.h_freq = 30
@@ -39,7 +41,7 @@ class Preprocessor:
         return self
 
     def transform(self, epochs):
-        epochs = mne.filter.filter_data(epochs, 125, self.l_freq, self.h_freq, verbose=False)
+        epochs = cached_filter_data(epochs, 125, self.l_freq, self.h_freq)
         if self.do_laplacian:
             epochs = laplacian(epochs)
         # epochs = epochs[:, :3, :]
@@ -47,6 +49,8 @@ class Preprocessor:
 
 
 class FeatureExtractor:
+    stateless = True
+
     def __init__(self):
         self.epoch_tmin = 0
         self.freq_bands = {
@@ -100,23 +104,14 @@ class FeatureExtractor:
         # band_power = [epoch_band_powers(epoch[:, imagination_start:], sfreq, freq_bands, welch_params) for epoch in
         #               epochs]
 
-        band_power = np.array(
-            [compute_pow_freq_bands(sfreq, epoch[:, imagination_start:], self.freq_bands, normalize=True,
-                                    psd_params=psd_params) for
-             epoch in
-             epochs]
-        )
+        band_power = pow_freq_bands(sfreq, epochs[:, :, imagination_start:], self.freq_bands, psd_params=psd_params)
         n = len(epochs[0, 0, :imagination_start])
         if self.n_per_seg > n:
             self.n_per_seg = n
         psd_params = {"welch_n_fft": 512, "welch_n_per_seg": self.n_per_seg,
                       "welch_n_overlap": int(self.n_per_seg * self.n_overlap)}
-        band_power_calib = np.array(
-            [compute_pow_freq_bands(sfreq, epoch[:, :imagination_start], self.freq_bands, normalize=True,
-                                    psd_params=psd_params) for
-             epoch in
-             epochs]
-        )
+        band_power_calib = pow_freq_bands(sfreq, epochs[:, :, :imagination_start], self.freq_bands,
+                                          psd_params=psd_params)
         # feature_funcs = [mnf.compute_mean, mnf.compute_std, mnf.compute_rms, mnf.compute_wavelet_coef_energy,
         #                  mnf.compute_samp_entropy, mnf.compute_app_entropy,
         #                  lambda data: mnf.compute_spect_entropy(125, data), mnf.compute_hjorth_mobility]
@@ -178,7 +173,10 @@ bayesian_search_space = {
 }
 
 
-def create_pipeline(hyperparams=None, model=LinearDiscriminantAnalysis):
+def create_pipeline(hyperparams=None, model=LinearDiscriminantAnalysis, incremental=False):
+    """
+    incremental: create a pipeline that can be updated with new epochs only, using pipeline.partial_fit_pipeline
+    """
     default_hyperparams = {
         "preprocessing__l_freq": 2,
         "preprocessing__h_freq": 15,
@@ -196,6 +194,10 @@ def create_pipeline(hyperparams=None, model=LinearDiscriminantAnalysis):
         hyperparams = default_hyperparams
         print("333 {h} {d}".format(h=hyperparams, d=default_hyperparams))
 
+    if incremental:
+        # the preprocessing and feature extraction are stateless, so only the model needs to be incremental
+        model = IncrementalLDA
+
     pipeline = Pipeline(
         [('preprocessing', Preprocessor()), ('feature_extraction', FeatureExtractor()), ('model', model())])
     print("Hyper - {h}".format(h=hyperparams))
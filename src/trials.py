@@ -0,0 +1,75 @@
+"""
+Database of every candidate evaluated by the hyperparam searches (see search.ModelSearch), kept across runs so a search
+resumes where it stopped, skips candidates already evaluated on the same data, and warm starts from the trials of
+previous searches of the subject (or of other subjects when the subject has few).
+Trials are identified by subject, pipeline name, model name and a fingerprint of the data (see search.data_key).
+"""
+import json
+import sqlite3
+from contextlib import closing
+
+from constants import TRIALS_PATH
+from data_utils import now_datestring
+
+WARM_START_MAX = 200  # previous trials the surrogate model is warm started with, the most recent ones
+WARM_START_MIN = 10  # other subjects' trials are used too when the subject has fewer previous trials than this
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (id INTEGER PRIMARY KEY, subject TEXT, pipeline TEXT, model TEXT, data TEXT,
+    date TEXT, params TEXT, score REAL, std REAL, fold_scores TEXT, fit_time REAL, failed INTEGER, pruned INTEGER);
+CREATE INDEX IF NOT EXISTS trials_search ON trials (pipeline, model, subject, data);
+"""
+COLUMNS = ["subject", "data", "date", "params", "score", "std", "fold_scores", "fit_time", "failed", "pruned"]
+
+
+def connect(trials_path=TRIALS_PATH):
+    conn = sqlite3.connect(trials_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class SearchTrials:
+    """
+    The trials of the searches of one model family with one pipeline, trials are dicts with the keys of COLUMNS
+    """
+
+    def __init__(self, subject, pipeline, model, trials_path=TRIALS_PATH):
+        self.subject = subject
+        self.pipeline = pipeline
+        self.model = model
+        self.trials_path = trials_path
+
+    def add(self, trial):
+        row = {**trial, "subject": self.subject, "date": now_datestring(), "params": json.dumps(trial["params"]),
+               "fold_scores": json.dumps(trial["fold_scores"])}
+        with closing(connect(self.trials_path)) as conn, conn:
+            conn.execute(f'INSERT INTO trials (pipeline, model, {", ".join(COLUMNS)}) VALUES '
+                         f'(?, ?, {", ".join("?" * len(COLUMNS))})',
+                         [self.pipeline, self.model] + [row[column] for column in COLUMNS])
+
+    def evaluated(self, data):
+        """
+        The trials evaluated on this data, oldest first
+        """
+        return self._query("data = ?", [data])
+
+    def previous(self, data):
+        """
+        The trials evaluated on other data (older sessions) to warm start a search on data with, most recent first
+        """
+        trials = self._query("subject = ? AND data != ?", [self.subject, data], newest_first=True)
+        if len(trials) < WARM_START_MIN:
+            trials += self._query("subject != ? AND data != ?", [self.subject, data], newest_first=True)
+        return trials[:WARM_START_MAX]
+
+    def _query(self, condition, args, newest_first=False):
+        with closing(connect(self.trials_path)) as conn:
+            rows = conn.execute(f'SELECT {", ".join(COLUMNS)} FROM trials WHERE pipeline = ? AND model = ? AND '
+                                f'{condition} ORDER BY id{" DESC" if newest_first else ""}',
+                                [self.pipeline, self.model] + args).fetchall()
+        trials = [dict(zip(COLUMNS, row)) for row in rows]
+        for trial in trials:
+            trial["params"] = json.loads(trial["params"])
+            trial["fold_scores"] = json.loads(trial["fold_scores"])
+            trial["failed"], trial["pruned"] = bool(trial["failed"]), bool(trial["pruned"])
+        return trials
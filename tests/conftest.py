@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture(autouse=True)
+def src_dir(monkeypatch):
+    # the paths in constants are relative to src, where the scripts are run from
+    monkeypatch.chdir(SRC_DIR)
@@ -0,0 +1,57 @@
+import mne
+import numpy as np
+
+from board import STIM_CHAN_NAME, ReplayBoard, RingBuffer
+
+
+def save_raw(path, n_channels=2, n_samples=2000, sfreq=125, markers=()):
+    rng = np.random.default_rng(0)
+    stim = np.zeros((1, n_samples))
+    for sample, marker in markers:
+        stim[0, sample] = marker
+    info = mne.create_info([f'EEG{i}' for i in range(n_channels)] + [STIM_CHAN_NAME], sfreq,
+                           ["eeg"] * n_channels + ["stim"])
+    raw = mne.io.RawArray(np.concatenate([rng.normal(scale=10e-6, size=(n_channels, n_samples)), stim]), info,
+                          verbose=False)
+    raw.save(path, verbose=False)
+    return raw
+
+
+def test_ring_buffer():
+    data = np.arange(50, dtype=float).reshape(2, 25)
+    buffer = RingBuffer(2, 10)
+    for start in range(0, 25, 7):
+        buffer.append(data[:, start:start + 7])
+    assert buffer.n_samples == 25
+    np.testing.assert_array_equal(buffer.latest(4), data[:, -4:])
+    np.testing.assert_array_equal(buffer.latest(100), data[:, -10:])
+    np.testing.assert_array_equal(buffer.get(17, 22), data[:, 17:22])
+    assert buffer.get(14, 20) is None  # overwritten
+    assert buffer.get(20, 26) is None  # not appended yet
+
+
+def test_board_update_keeps_every_sample(tmp_path):
+    path = str(tmp_path / "raw.fif")
+    raw = save_raw(path, markers=[(300, 1), (1200, 2)])
+    board = ReplayBoard(path, speed=None, buffer_seconds=30)
+    with board:
+        while not board.finished:
+            board.update()
+    expected = raw.get_data()
+    assert board.ring_buffer.n_samples == expected.shape[1]
+    np.testing.assert_allclose(board.ring_buffer.latest(expected.shape[1]), expected)
+    assert board.markers == [(300, 1), (1200, 2)]
+
+
+def test_get_latest_epoch_matches_mne_epochs(tmp_path):
+    path = str(tmp_path / "raw.fif")
+    raw = save_raw(path, markers=[(300, 1), (1200, 2)])
+    board = ReplayBoard(path, speed=None, buffer_seconds=30)
+    with board:
+        while not board.finished:
+            board.update()
+        epoch, marker = board.get_latest_epoch(-1, 4)
+    events = mne.find_events(raw, verbose=False)
+    expected = mne.Epochs(raw, events, tmin=-1, tmax=4, picks="data", baseline=None, verbose=False).get_data()
+    assert marker == 2
+    np.testing.assert_allclose(epoch, expected[-1])
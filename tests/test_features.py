@@ -0,0 +1,13 @@
+import numpy as np
+from mne_features.univariate import compute_pow_freq_bands
+
+import spectral
+from features import pow_freq_bands
+
+
+def test_pow_freq_bands_matches_mne_features():
+    rng = np.random.default_rng(0)
+    epochs = rng.normal(size=(6, 3, 250))
+    psd_params = {"welch_n_fft": 512, "welch_n_per_seg": 125, "welch_n_overlap": 62}
+    expected = [compute_pow_freq_bands(125, epoch, spectral.all_freq_bands, psd_params=psd_params) for epoch in epochs]
+    np.testing.assert_allclose(pow_freq_bands(125, epochs, spectral.all_freq_bands, psd_params=psd_params), expected)
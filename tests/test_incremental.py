@@ -0,0 +1,50 @@
+import mne
+import numpy as np
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+
+from incremental import IncrementalCSP, IncrementalLDA
+
+
+def class_epochs(n_epochs=40, n_channels=4, n_times=200, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = np.tile([1, 2], n_epochs // 2)
+    # the classes differ in the variance of one channel each
+    scales = np.ones((n_epochs, n_channels, 1))
+    scales[labels == 1, 0] = 3
+    scales[labels == 2, 1] = 3
+    return rng.normal(size=(n_epochs, n_channels, n_times)) * scales, labels
+
+
+def test_incremental_lda_matches_lda():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(90, 5)) + np.repeat(np.eye(3, 5), 30, axis=0)
+    y = np.repeat([1, 2, 3], 30)
+    order = rng.permutation(len(y))
+    X, y = X[order], y[order]
+    lda = LinearDiscriminantAnalysis(solver="lsqr").fit(X, y)
+    incremental = IncrementalLDA()
+    for batch in np.array_split(np.arange(len(y)), 4):
+        incremental.partial_fit(X[batch], y[batch])
+    np.testing.assert_allclose(incremental.coef_, lda.coef_)
+    np.testing.assert_allclose(incremental.intercept_, lda.intercept_)
+    np.testing.assert_array_equal(incremental.predict(X), lda.predict(X))
+
+
+def test_incremental_csp_matches_mne():
+    epochs, labels = class_epochs()
+    csp = mne.decoding.CSP(n_components=4, transform_into="csp_space").fit(epochs, labels)
+    incremental = IncrementalCSP(n_components=4).fit(epochs, labels)
+    # the power of every component (the csp features), mne>=1.0 estimates the covariances a bit differently than np.cov
+    power = (incremental.transform(epochs) ** 2).sum(axis=2)
+    np.testing.assert_allclose(power, (csp.transform(epochs) ** 2).sum(axis=2), rtol=1e-2)
+
+
+def test_incremental_csp_waits_for_two_classes():
+    epochs, labels = class_epochs()
+    order = np.argsort(labels, kind="stable")
+    incremental = IncrementalCSP(n_components=4)
+    incremental.partial_fit(epochs[order[:20]], labels[order[:20]])  # a single class
+    assert incremental.filters_ is None
+    incremental.partial_fit(epochs[order[20:]], labels[order[20:]])
+    expected = IncrementalCSP(n_components=4).fit(epochs, labels)
+    np.testing.assert_allclose(np.abs(incremental.transform(epochs)), np.abs(expected.transform(epochs)), rtol=1e-6)
@@ -0,0 +1,15 @@
+import numpy as np
+
+from inference import InferenceRuntime, PipelineRuntime, create_runtime
+from test_model_artifact import EXPORTED_MODELS, fitted_pipelines
+
+
+def test_runtimes_predict_like_their_pipelines():
+    for pipe, epochs in fitted_pipelines():
+        runtime = create_runtime(pipe)
+        exported = isinstance(pipe.steps[-1][1], EXPORTED_MODELS)
+        assert isinstance(runtime, InferenceRuntime if exported else PipelineRuntime)
+        expected = pipe.predict(epochs)
+        np.testing.assert_array_equal(runtime.predict(epochs), expected)
+        # one epoch at a time, as in run_session
+        np.testing.assert_array_equal([runtime.predict(epoch) for epoch in epochs[:5]], expected[:5])
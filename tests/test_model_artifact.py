@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.ensemble import AdaBoostClassifier, GradientBoostingClassifier, RandomForestClassifier
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.svm import SVC
+
+import csp
+import spectral
+from incremental import IncrementalLDA
+from model_artifact import export_pipeline, load_artifact, save_artifact
+
+# the models of Workflows.models (and the incremental LDA), with the SVC kernels that have coef_
+MODELS = [LinearDiscriminantAnalysis, IncrementalLDA, lambda: SVC(kernel="linear"), SVC, RandomForestClassifier,
+          GradientBoostingClassifier, AdaBoostClassifier, KNeighborsClassifier]
+EXPORTED_MODELS = (LinearDiscriminantAnalysis, IncrementalLDA)
+
+
+def class_epochs(n_epochs=60, n_channels=6, n_times=626, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = np.resize([1, 2, 3], n_epochs)
+    epochs = rng.normal(scale=10e-6, size=(n_epochs, n_channels, n_times))
+    # a 10 Hz rhythm on a different channel for every class
+    rhythm = 10e-6 * np.sin(2 * np.pi * 10 * np.arange(n_times) / 125)
+    epochs[np.arange(n_epochs), labels - 1] += rhythm
+    return epochs, labels
+
+
+def fitted_pipelines():
+    epochs, labels = class_epochs()
+    for pipeline, hyperparams in [(spectral, None), (csp, {"csp__n_components": 4})]:
+        for model in MODELS:
+            pipe = pipeline.create_pipeline(hyperparams)
+            pipe.steps[-1] = ("model", model())
+            yield pipe.fit(epochs, labels), epochs
+
+
+def test_artifacts_predict_like_their_pipelines(tmp_path):
+    n_exported = 0
+    for pipe, epochs in fitted_pipelines():
+        model = pipe.steps[-1][1]
+        if not isinstance(model, EXPORTED_MODELS):
+            with pytest.raises(ValueError):
+                export_pipeline(pipe)
+            continue
+        path = str(tmp_path / "pipeline.npz")
+        save_artifact(export_pipeline(pipe), path)
+        np.testing.assert_array_equal(load_artifact(path).predict(epochs), pipe.predict(epochs))
+        n_exported += 1
+    assert n_exported == 2 * len(EXPORTED_MODELS)
@@ -0,0 +1,30 @@
+import numpy as np
+from sklearn.model_selection import cross_validate
+
+import csp
+import spectral
+from pipeline import cross_validation, split_stateless, transform_steps
+from preprocessing import EpochRejector
+
+
+def random_epochs(n_epochs=40, n_channels=4, n_times=626, seed=0):
+    rng = np.random.default_rng(seed)
+    epochs = rng.normal(scale=10e-6, size=(n_epochs, n_channels, n_times))
+    labels = np.tile([1, 2], n_epochs // 2)
+    return epochs, labels
+
+
+def test_split_stateless_scores_match_full_cross_validation():
+    epochs, labels = random_epochs()
+    for pipeline in [spectral, csp]:
+        pipe = pipeline.create_pipeline()
+        prefix, tail = split_stateless(pipe)
+        assert prefix
+        expected = cross_validate(pipe, epochs, labels, cv=cross_validation(5))["test_score"]
+        scores = cross_validate(tail, transform_steps(prefix, epochs), labels, cv=cross_validation(5))["test_score"]
+        np.testing.assert_allclose(scores, expected)
+
+
+def test_split_stateless_leaves_other_estimators_whole():
+    rejector = EpochRejector(spectral.create_pipeline())
+    assert split_stateless(rejector) == ([], rejector)
@@ -0,0 +1,50 @@
+import os
+
+import mne
+import numpy as np
+
+import spectral
+from pipeline import evaluate_pipeline
+from preprocessing import EpochRejector, FilterCache, good_epochs_mask, reject_epochs
+
+
+def test_filter_cache_is_memory_only_by_default(tmp_path):
+    epochs = np.random.default_rng(0).normal(size=(4, 2, 250))
+    cache = FilterCache(cache_dir=str(tmp_path))
+    filtered = cache.filter_data(epochs, 125, 7, 30)
+    np.testing.assert_array_equal(filtered, mne.filter.filter_data(epochs, 125, 7, 30, verbose=False))
+    assert cache.filter_data(epochs, 125, 7, 30) is filtered
+    assert not os.listdir(tmp_path)
+
+    disk_cache = FilterCache(cache_dir=str(tmp_path), max_disk_bytes=2 ** 20)
+    disk_cache.filter_data(epochs, 125, 7, 30)
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_epoch_quality_ptp_high():
+    epochs = np.zeros((2, 2, 100))
+    epochs[0, 1, :50] = 60e-6
+    epochs[0, 1, 50:] = -60e-6
+    epochs[1] = np.linspace(0, 50e-6, 100)
+    good, reasons = good_epochs_mask(epochs, 0, amp_low=None, amp_high=None, ptp_high=100e-6, flat=1e-6)
+    np.testing.assert_array_equal(good, [False, True])
+    np.testing.assert_array_equal(reasons["ptp_high"], [[False, True], [False, False]])
+    np.testing.assert_array_equal(reasons["flat"], [[True, False], [False, False]])
+
+
+def test_reject_epochs_amplitude_only_by_default():
+    epochs = np.full((3, 4, 100), 10e-6)
+    epochs[1, :] = 300e-6  # every channel over EPOCH_AMP_HIGH
+    labels = np.array([1, 2, 3])
+    kept_epochs, kept_labels = reject_epochs(epochs, labels)
+    np.testing.assert_array_equal(kept_labels, [1, 3])  # the (flat) constant epochs are kept
+    _, kept_labels = reject_epochs(epochs, labels, flat=1e-6)
+    assert len(kept_labels) == 0
+
+
+def test_evaluate_epoch_rejector():
+    rng = np.random.default_rng(0)
+    epochs = rng.normal(scale=10e-6, size=(40, 4, 500))
+    labels = np.tile([1, 2], 20)
+    score = evaluate_pipeline(EpochRejector(spectral.create_pipeline()), epochs, labels, n_splits=2)
+    assert 0 <= score <= 1
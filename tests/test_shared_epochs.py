@@ -0,0 +1,26 @@
+import numpy as np
+from sklearn.model_selection import cross_validate
+
+import spectral
+from pipeline import cross_validation, cv_data
+from preprocessing import EpochRejector
+from shared_epochs import share_epochs, strip_loader
+
+
+def test_shared_epochs_cross_validation_matches_epochs():
+    rng = np.random.default_rng(0)
+    epochs = rng.normal(scale=10e-6, size=(40, 4, 500))
+    labels = np.tile([1, 2], 20)
+    for pipe in [spectral.create_pipeline(), EpochRejector(spectral.create_pipeline())]:
+        expected = cross_validate(pipe, epochs, labels, cv=cross_validation(5))["test_score"]
+        with cv_data(pipe, epochs) as (cv_pipe, X):
+            scores = cross_validate(cv_pipe, X, labels, cv=cross_validation(5))["test_score"]
+        np.testing.assert_allclose(scores, expected)
+
+
+def test_strip_loader():
+    rejector = EpochRejector(spectral.create_pipeline())
+    with share_epochs(np.zeros((2, 1, 10))) as shared:
+        assert strip_loader(shared.pipeline(rejector)) is rejector
+        pipe = spectral.create_pipeline()
+        assert [name for name, _ in strip_loader(shared.pipeline(pipe)).steps] == [name for name, _ in pipe.steps]